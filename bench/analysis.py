@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+"""Compare the NumPy analysis of the measurements with a plain csv module one.
+
+Writes --files synthetic CSV files of --rows measurements each, shaped
+like the Keygen_*.csv files of the extensive test (the key in hex, then
+the duration), and analyzes them with analyze_measurements() of
+tpm2-algtest-ui.py and with a naive baseline, which reads every file
+with csv.DictReader and sorts the durations for the percentiles.
+Reported are the duration and the peak memory allocated by Python
+(tracemalloc, which also sees the allocations of NumPy) of both, and
+the largest relative difference between their results. NumPy is
+imported beforehand, its import time is reported separately.
+"""
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import load_ui
+
+
+def write_csv(path, rows, rng):
+    with open(path, "w") as csv_file:
+        csv_file.write("id,n,e,duration,duration_extra\n")
+        for i in range(rows):
+            duration = rng.lognormvariate(-2, 0.3) if rng.random() > 0.01 else rng.uniform(1, 2)
+            csv_file.write("%d,%0512x,65537,%.6f,0\n" % (i, rng.getrandbits(2048), duration))
+
+
+def percentile(values, fraction):
+    # linear interpolation between the closest ranks, like numpy.percentile()
+    position = fraction * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def analyze_naive(detail_dir, ui):
+    analysis = {}
+    for name in sorted(os.listdir(detail_dir)):
+        if not name.startswith(ui.ANALYSIS_PREFIXES) or not name.endswith(".csv"):
+            continue
+        with open(os.path.join(detail_dir, name), newline="") as csv_file:
+            durations = sorted(float(row["duration"]) for row in csv.DictReader(csv_file))
+        q1, q3 = percentile(durations, 0.25), percentile(durations, 0.75)
+        fence = ui.ANALYSIS_OUTLIER_IQR * (q3 - q1)
+        total = sum(durations)
+        analysis[name[:-len(".csv")]] = {
+            "samples": len(durations),
+            "mean": total / len(durations),
+            "median": percentile(durations, 0.5),
+            "p95": percentile(durations, 0.95),
+            "p99": percentile(durations, 0.99),
+            "min": durations[0],
+            "max": durations[-1],
+            "outliers": sum(1 for value in durations if value < q1 - fence or value > q3 + fence),
+            "throughput": len(durations) / total,
+        }
+    return analysis
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def largest_difference(analysis, reference):
+    difference = 0.0
+    for name, stats in reference.items():
+        for key, value in stats.items():
+            if value:
+                difference = max(difference, abs(analysis[name][key] / value - 1))
+    return difference
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=100000, help="measurements per file (extensive test: 100000)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ui = load_ui()
+    detail_dir = tempfile.mkdtemp(prefix="analysis-")
+    try:
+        rng = random.Random(args.seed)
+        for i in range(args.files):
+            write_csv(os.path.join(detail_dir, "Keygen_RSA_%d.csv" % i), args.rows, rng)
+        size = sum(os.path.getsize(os.path.join(detail_dir, name)) for name in os.listdir(detail_dir))
+        print("%d files, %d rows each, %.1f MB" % (args.files, args.rows, size / 2**20))
+
+        # imported by analyze_measurements() on its first call, which is not measured
+        start = time.perf_counter()
+        try:
+            import numpy
+        except ImportError:
+            sys.exit("NumPy is not installed")
+        print("importing numpy: %.3f s" % (time.perf_counter() - start))
+
+        analysis, duration, peak = measure(ui.analyze_measurements, detail_dir)
+        reference, naive_duration, naive_peak = measure(analyze_naive, detail_dir, ui)
+        print("numpy:      %.3f s, peak memory %.1f MB" % (duration, peak / 2**20))
+        print("csv module: %.3f s, peak memory %.1f MB" % (naive_duration, naive_peak / 2**20))
+        print("speed-up %.1fx, largest relative difference of the results %.2g" % (
+            naive_duration / duration, largest_difference(analysis, reference)))
+    finally:
+        shutil.rmtree(detail_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""Helpers shared by the benchmark scripts."""
+
+import importlib.util
+import os
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UI_SCRIPT = os.path.join(REPO_DIR, "tpm2-algtest-ui.py")
+
+
+def load_ui():
+    """Import tpm2-algtest-ui.py, whose file name is not a valid module name."""
+    spec = importlib.util.spec_from_file_location("tpm2_algtest_ui", UI_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def describe(samples):
+    return "min %.3f s, median %.3f s, max %.3f s" % (min(samples), statistics.median(samples), max(samples))
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+"""Compare the durable write path with the former copyfile() + os.sync().
+
+By default a loopback image formatted like the ALGTEST_RES volume is
+created and mounted, which requires root. Use --target to benchmark an
+already mounted directory (e.g. a real USB stick) instead.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from common import load_ui, describe
+
+
+def copy_and_sync(source, destination, readme):
+    shutil.copyfile(source, destination)
+    with open(readme, "w") as readme_file:
+        readme_file.write("README")
+    os.sync()
+
+
+def durable(ui, source, destination, readme):
+    ui.durable_copy(source, destination)
+    ui.durable_write(readme, [b"README"])
+
+
+def measure(function, target, source, repeat):
+    samples = []
+    for i in range(repeat):
+        destination = os.path.join(target, "algtest_result_%d.zip" % i)
+        start = time.monotonic()
+        function(source, destination, os.path.join(target, "README_AND_HOW_TO_UPLOAD.txt"))
+        samples.append(time.monotonic() - start)
+        os.unlink(destination)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=16, help="archive size in MiB (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of copies per method (default: %(default)s)")
+    parser.add_argument("--image-size", type=int, default=256, help="loopback image size in MiB (default: %(default)s)")
+    parser.add_argument("--mkfs", default="mkfs.vfat", help="command formatting the image (default: %(default)s)")
+    parser.add_argument("--target", help="benchmark this mounted directory instead of a loopback image")
+    args = parser.parse_args()
+
+    ui = load_ui()
+    work_dir = tempfile.mkdtemp()
+    source = os.path.join(work_dir, "algtest_result.zip")
+    with open(source, "wb") as source_file:
+        source_file.write(os.urandom(args.size * 2**20))
+
+    target = args.target
+    image = None
+    try:
+        if target is None:
+            image = os.path.join(work_dir, "algtest_res.img")
+            target = os.path.join(work_dir, "mnt")
+            os.makedirs(target)
+            subprocess.run(["truncate", "-s", "%dM" % args.image_size, image], check=True)
+            subprocess.run([args.mkfs, image], check=True, stdout=subprocess.DEVNULL)
+            subprocess.run(["mount", "-o", "loop", image, target], check=True)
+
+        results = {
+            "copyfile + os.sync": measure(copy_and_sync, target, source, args.repeat),
+            "durable_copy": measure(lambda *paths: durable(ui, *paths), target, source, args.repeat),
+        }
+        for method, samples in results.items():
+            print("%-20s %s (%.1f MiB/s median)" % (method, describe(samples),
+                                                    args.size / sorted(samples)[len(samples) // 2]))
+    finally:
+        if image is not None:
+            subprocess.run(["umount", target])
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
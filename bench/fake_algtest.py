@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+"""Stand-in for run_algtest which emits synthetic output at a controlled rate.
+
+The output is a mix of status markers, percentage lines and bulk text in
+the given proportions. Every bulk text line carries the time it was
+written, so that the reader can measure the latency.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+
+def parse_mix(text):
+    mix = {"status": 0, "percent": 0, "text": 0}
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        if kind not in mix:
+            raise argparse.ArgumentTypeError("unknown line kind " + kind)
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=0, help="lines per second, 0 for as fast as possible")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("status=1,percent=50,text=49"))
+    parser.add_argument("--flush-every", type=int, default=1, help="lines written between flushes")
+    parser.add_argument("--seed", type=int, default=0)
+    # the options run_algtest gets from the runner, and the category
+    args, _ = parser.parse_known_args()
+
+    rng = random.Random(args.seed)
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    test, tests, percent = 1, 100, 0
+    start = time.monotonic()
+    out = sys.stdout
+    out.write("+++Running firehose (%d/%d)+++\n" % (test, tests))
+
+    for i in range(args.lines):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "status":
+            test = test % tests + 1
+            percent = 0
+            out.write("+++Running firehose (%d/%d)+++\n" % (test, tests))
+        elif kind == "percent":
+            percent = (percent + 1) % 101
+            out.write("%d%%\n" % percent)
+        else:
+            out.write("bulk line %d of the synthetic output @%.6f\n" % (i, time.time()))
+
+        if (i + 1) % args.flush_every == 0:
+            out.flush()
+        if args.rate:
+            delay = start + (i + 1) / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
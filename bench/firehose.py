@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+"""Measure how fast the runner consumes run_algtest output.
+
+Every scenario runs bench/fake_algtest.py through
+AlgtestTestRunner.run_and_monitor(), as the runner thread does, while
+another thread polls the runner the way main_ui_loop() refreshes the UI.
+Reported are the throughput in lines/s, the CPU time of the runner
+thread per line, the time spent waiting for info_lock, and percentiles
+of the UI latency (from a line being written by the child to the UI
+seeing it) and of the duration of one UI refresh.
+
+With --session, recorded sessions (see --record of tpm2-algtest-ui.py)
+are replayed as fast as possible as additional scenarios, so real
+workloads can be measured without a TPM.
+
+The results are compared with a stored baseline (see --save-baseline),
+a regression above --tolerance makes the script exit with 1.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from threading import Lock, Thread, Event
+
+from common import load_ui
+
+FAKE_ALGTEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_algtest.py")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "firehose_baseline.json")
+# main_ui_loop() waits for events for 100 ms
+UI_REFRESH_INTERVAL = 0.1
+
+SCENARIOS = {
+    "steady": ["--lines", "20000", "--rate", "2000", "--mix", "status=1,percent=50,text=49"],
+    "percent-storm": ["--lines", "100000", "--mix", "status=0.1,percent=99.9,text=0"],
+    "bulk-text": ["--lines", "100000", "--mix", "status=0,percent=0,text=1", "--flush-every", "100"],
+    "mixed": ["--lines", "100000", "--mix", "status=1,percent=50,text=49"],
+}
+
+# metrics where a higher value is better, for the rest lower is better
+HIGHER_IS_BETTER = {"lines_per_s"}
+
+
+class TimedLock:
+    """Lock which records how long every acquire() waited."""
+    def __init__(self):
+        self.lock = Lock()
+        self.waits = []
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.waits.append(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def poll_like_ui(runner, stop, latencies, refreshes):
+    cursor, version = 0, None
+    while not stop.wait(UI_REFRESH_INTERVAL):
+        start = time.perf_counter()
+        snapshot = runner.get_snapshot()
+        if snapshot.version == version:
+            refreshes.append(time.perf_counter() - start)
+            continue
+        version = snapshot.version
+        cursor, lines = runner.get_text_since(cursor)
+        "\n".join(lines)
+        refreshes.append(time.perf_counter() - start)
+
+        now = time.time()
+        for line in lines:
+            _, marker, written = line.rpartition("@")
+            if marker:
+                try:
+                    latencies.append(now - float(written))
+                except ValueError:
+                    pass
+
+
+def run_scenario(ui, args=None, session=None):
+    out_dir = tempfile.mkdtemp(prefix="firehose-")
+    try:
+        replay = ui.SessionReplay(session, speed=0) if session is not None else None
+        runner = ui.AlgtestTestRunner(out_dir, False, replay=replay)
+        runner.info_lock = TimedLock()
+        stop = Event()
+        latencies, refreshes = [], []
+        poller = Thread(target=poll_like_ui, args=(runner, stop, latencies, refreshes))
+        poller.start()
+
+        lines_before = runner.log.next_seq
+        wall_start, cpu_start = time.monotonic(), time.thread_time()
+        if replay is None:
+            runner.run_and_monitor([sys.executable, FAKE_ALGTEST] + args, phase="firehose")
+            lines = int(args[args.index("--lines") + 1])
+        else:
+            lines = sum(chunk.count(b"\n") for process in replay.processes for _, chunk in process["chunks"])
+            while replay.remaining():
+                runner.run_and_monitor(replay.processes[0]["cmd"], phase="replay")
+        cpu, wall = time.thread_time() - cpu_start, time.monotonic() - wall_start
+        time.sleep(2 * UI_REFRESH_INTERVAL)
+        stop.set()
+        poller.join()
+        runner.run_log.close()
+
+        waits = runner.info_lock.waits
+        return {
+            "lines_per_s": lines / wall,
+            "cpu_us_per_line": 1e6 * cpu / lines,
+            "lock_acquisitions_per_line": len(waits) / lines,
+            "lock_wait_ms_total": 1e3 * sum(waits),
+            "lock_wait_ms_max": 1e3 * max(waits, default=0),
+            "ui_latency_ms_p50": 1e3 * percentile(latencies, 0.5),
+            "ui_latency_ms_p95": 1e3 * percentile(latencies, 0.95),
+            "ui_latency_ms_p99": 1e3 * percentile(latencies, 0.99),
+            "ui_refresh_ms_p95": 1e3 * percentile(refreshes, 0.95),
+            "lines_logged": runner.log.next_seq - lines_before,
+        }
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(scenario, {}).get(metric)
+            if not reference or metric == "lines_logged":
+                continue
+            change = value / reference - 1
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append("%s %s: %.3f, baseline %.3f" % (scenario, metric, value, reference))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help="scenarios to run: %s (default: all)" % ", ".join(SCENARIOS))
+    parser.add_argument("--session", action="append", default=[], help="also replay this recorded session")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario " + scenario)
+
+    ui = load_ui()
+    results = {}
+    scenarios = [(scenario, SCENARIOS[scenario], None) for scenario in args.scenarios or SCENARIOS]
+    scenarios += [("session " + os.path.basename(session), None, session) for session in args.session]
+    for scenario, scenario_args, session in scenarios:
+        results[scenario] = run_scenario(ui, scenario_args, session)
+        print("%s:" % scenario)
+        for metric, value in results[scenario].items():
+            print("  %-28s %12.3f" % (metric, value))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=1)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, store one with --save-baseline.")
+        return 0
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
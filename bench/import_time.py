@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""Measure the start-up import cost of tpm2-algtest-ui.py.
+
+Every sample is a fresh interpreter, so nothing is cached in-process.
+The cost of loading the script itself is compared with the cost of the
+modules which are now imported only when needed (requests,
+http.client, yui and numpy); the latter is what the headless mode
+saves.
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+from common import UI_SCRIPT, describe
+
+LOAD_SCRIPT = """
+import importlib.util
+spec = importlib.util.spec_from_file_location("tpm2_algtest_ui", %r)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+""" % UI_SCRIPT
+
+DEFERRED_MODULES = ["requests", "http.client", "yui", "numpy"]
+
+
+def available(module):
+    return subprocess.run([sys.executable, "-c", "import " + module], stderr=subprocess.DEVNULL).returncode == 0
+
+
+def measure(code, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        samples.append(time.monotonic() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    modules = [module for module in DEFERRED_MODULES if available(module)]
+    missing = sorted(set(DEFERRED_MODULES) - set(modules))
+    if missing:
+        print("not installed, not measured: " + ", ".join(missing))
+
+    print("interpreter only:        " + describe(measure("pass", args.repeat)))
+    print("tpm2-algtest-ui.py:      " + describe(measure(LOAD_SCRIPT, args.repeat)))
+    if modules:
+        print("+ " + ", ".join(modules) + ": " + describe(measure(LOAD_SCRIPT + "import " + ", ".join(modules),
+                                                                  args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""Test several simulated TPMs at once and compare it with testing them one by one.
+
+Starts --devices swtpm instances listening on local TCP ports and runs
+the headless mode of tpm2-algtest-ui.py against them, first with all of
+them in parallel and then with --jobs 1. Needs swtpm and run_algtest
+(with tpm2-algtest) installed, no TPM hardware is used. The results are
+not stored.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import UI_SCRIPT
+
+BASE_PORT = 2321
+
+
+def start_swtpm(state_dir, port):
+    os.makedirs(state_dir, exist_ok=True)
+    return subprocess.Popen(["swtpm", "socket", "--tpm2", "--tpmstate", "dir=" + state_dir,
+                             "--server", "type=tcp,port=%d" % port, "--ctrl", "type=tcp,port=%d" % (port + 1),
+                             "--flags", "not-need-init,startup-clear"])
+
+
+def run(tctis, jobs, extra_args):
+    cmd = [sys.executable, UI_SCRIPT, "--headless", "--store", "none", "--jobs", str(jobs)] + extra_args
+    for tcti in tctis:
+        cmd += ["--tcti", tcti]
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    states = {}
+    for line in proc.stdout:
+        event = json.loads(line)
+        if event["event"] == "finished":
+            states[event.get("device")] = event["state"]
+    proc.wait()
+    return time.monotonic() - start, proc.returncode, states
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=10, help="repetitions of the performance tests")
+    args = parser.parse_args()
+
+    if shutil.which("swtpm") is None:
+        sys.exit("swtpm is not installed")
+
+    state_dir = tempfile.mkdtemp(prefix="swtpm-")
+    ports = [BASE_PORT + 2 * i for i in range(args.devices)]
+    simulators = [start_swtpm(os.path.join(state_dir, str(port)), port) for port in ports]
+    tctis = ["swtpm:host=127.0.0.1,port=%d" % port for port in ports]
+    try:
+        time.sleep(1)
+        extra_args = ["--iterations", str(args.iterations)]
+        for jobs in (args.devices, 1):
+            duration, code, states = run(tctis, jobs, extra_args)
+            print("%d job(s): %.1f s, exit code %d, %s" % (jobs, duration, code,
+                                                            ", ".join("%s %s" % item for item in states.items())))
+    finally:
+        for simulator in simulators:
+            simulator.terminate()
+            simulator.wait()
+        shutil.rmtree(state_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""Drain an upload outbox against a local stand-in of the depository.
+
+Creates --archives fake result archives with their summaries, and one
+of a failed run, in a temporary directory (the ALGTEST_RES volume) and
+drains its outbox with UploadOutbox.drain() and one ISUploader pointed
+at a local HTTP server, which answers like the depository and fails the
+first request of every --flaky-th archive. Two drains run at the same
+time, as when the UI starts draining while the user uploads, and then
+once more; every file of the successful runs must reach the server
+exactly once, the failed run must not be uploaded. Reported is when the
+last summary and the last archive arrived. This is repeated with
+--jobs 1 to compare the duration of the drain.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from common import load_ui
+
+
+class StandInDepository(BaseHTTPRequestHandler):
+    """Accepts the uploads like the depository, counting them per file name."""
+    lock = Lock()
+    uploads = Counter()
+    attempts = Counter()
+    arrivals = {}
+    flaky = 0
+    delay = 0.0
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        name = re.search(rb'name="A_NAZEV_1"\r\n\r\n([^\r]*)', body).group(1).decode()
+        time.sleep(self.delay)
+        with self.lock:
+            self.attempts[name] += 1
+            fail = self.flaky and int(re.search(r"(\d+)", name).group(1)) % self.flaky == 0 \
+                and self.attempts[name] == 1
+            if not fail:
+                self.uploads[name] += 1
+                self.arrivals[name] = time.monotonic()
+        self.send_response(503 if fail else 200)
+        self.end_headers()
+        if not fail:
+            self.wfile.write(json.dumps({"uspech": 1}).encode())
+
+    def log_message(self, *_):
+        pass
+
+
+def create_archives(directory, count, size, summary_suffix):
+    for i in range(count + 1):
+        with open(os.path.join(directory, "algtest_result_%04d.zip" % i), "wb") as archive:
+            archive.write(os.urandom(size))
+        with open(os.path.join(directory, "algtest_result_%04d%s" % (i, summary_suffix)), "w") as summary:
+            # the last run failed
+            json.dump({"state": "SUCCESS" if i < count else "FAILED"}, summary)
+
+
+def run(ui, url, archives, size, jobs):
+    directory = tempfile.mkdtemp(prefix="outbox-")
+    StandInDepository.uploads.clear()
+    StandInDepository.attempts.clear()
+    StandInDepository.arrivals.clear()
+    try:
+        create_archives(directory, archives, size, ui.SUMMARY_SUFFIX)
+        uploader = ui.ISUploader("tpm2-algtest-ui", ui.DEPOSITORY_UCO, url=url)
+        results = []
+        start = time.monotonic()
+        drains = [Thread(target=lambda: results.append(ui.UploadOutbox(directory).drain(uploader, jobs)))
+                  for _ in range(2)]
+        for drain in drains:
+            drain.start()
+        for drain in drains:
+            drain.join()
+        duration = time.monotonic() - start
+        # a further drain, e.g. after the next launch, must not upload anything again
+        again = ui.UploadOutbox(directory).drain(uploader, jobs)
+        states = Counter(entry["state"] for entry in ui.UploadOutbox(directory).load().values())
+        arrivals = StandInDepository.arrivals
+        last_summary = max(arrivals[name] for name in arrivals if name.endswith(ui.SUMMARY_SUFFIX)) - start
+        last_archive = max(arrivals[name] for name in arrivals if name.endswith(".zip")) - start
+        return duration, results, again, states, last_summary, last_archive
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--archives", type=int, default=20)
+    parser.add_argument("--size", type=int, default=1 << 20, help="bytes of every archive")
+    parser.add_argument("--flaky", type=int, default=5, help="fail the first upload of every N-th archive, 0 for none")
+    parser.add_argument("--delay", type=float, default=0.05, help="seconds the server needs for every upload")
+    parser.add_argument("--jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    ui = load_ui()
+    # the retries are not the subject of the measurement
+    ui.UPLOAD_BACKOFF = 0.1
+    StandInDepository.flaky = args.flaky
+    StandInDepository.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInDepository)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/dok/depository_in" % server.server_address[1]
+
+    failed = False
+    try:
+        for jobs in (args.jobs, 1):
+            duration, results, again, states, last_summary, last_archive = run(ui, url, args.archives, args.size,
+                                                                               jobs)
+            uploads = StandInDepository.uploads
+            duplicates = sorted(name for name, count in uploads.items() if count > 1)
+            missing = 2 * args.archives - len(uploads)
+            incomplete = sorted(name for name in uploads if name.startswith("algtest_result_%04d" % args.archives))
+            print("%d job(s): %.2f s (summaries %.2f s, archives %.2f s), %d requests, states %s, "
+                  "drained concurrently: %s, again: %d file(s)" % (
+                      jobs, duration, last_summary, last_archive, sum(StandInDepository.attempts.values()),
+                      dict(states), ", ".join("busy" if result is None else str(len(result)) for result in results),
+                      len(again)))
+            if duplicates or missing or incomplete:
+                print("FAILED: uploaded twice: %s, not uploaded: %d, of the failed run: %s" % (
+                    ", ".join(duplicates) or "none", missing, ", ".join(incomplete) or "none"))
+                failed = True
+    finally:
+        server.shutdown()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
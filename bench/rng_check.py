@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+"""Measure the RNG output check on an Rng.bin of the extensive test and on broken ones.
+
+The good output is --size MB from os.urandom(), as large as Rng.bin of
+the extensive test by default. The broken ones imitate the failures the
+check is for: a zero-filled tail of a truncated write, output repeated
+by a stuck generator, a stuck byte value and a truncated file. Every
+check must finish in well under a second, only the good output may pass.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import load_ui
+
+
+def scenarios(size):
+    good = os.urandom(size)
+    stuck = bytearray(good)
+    stuck[::97] = bytes(len(stuck[::97]))
+    return {
+        "good": (good, "PASS"),
+        "zero tail": (good[:size - size // 16] + bytes(size // 16), "FAIL"),
+        "repeated": (good[:size // 2] * 2, "FAIL"),
+        "stuck byte": (bytes(stuck), "FAIL"),
+        "truncated": (good[:100], "FAIL"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=14, help="MB of random data (extensive test: 14)")
+    args = parser.parse_args()
+
+    ui = load_ui()
+    directory = tempfile.mkdtemp(prefix="rng-check-")
+    unexpected = False
+    try:
+        for name, (data, expected) in scenarios(int(args.size * 2**20)).items():
+            path = os.path.join(directory, ui.RNG_NAME)
+            with open(path, "wb") as rng_file:
+                rng_file.write(data)
+            # the first call imports NumPy
+            ui.check_rng_output(path)
+            tracemalloc.start()
+            start = time.perf_counter()
+            rng_check = ui.check_rng_output(path)
+            duration = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if rng_check is None:
+                sys.exit("NumPy is not installed")
+            print("%-10s %.3f s, peak memory %.1f MB: %s" % (name, duration, peak / 2**20,
+                                                            ui.format_rng_check(rng_check)))
+            unexpected = unexpected or rng_check["verdict"] != expected
+    finally:
+        shutil.rmtree(directory)
+    return 1 if unexpected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,22 +7,35 @@
 from collections import deque
 from enum import Enum, auto
 
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, wait
+import argparse
+import signal
 import subprocess
-import fcntl
+import select
+import selectors
 import os
-import requests
+import sys
 import json
 import datetime
 import re
+import time
+import errno
+import fcntl
+import gzip
+import hashlib
+import html
+import mmap
+import queue
+import struct
+import zipfile
 
-from shutil import copyfile
 from uuid import uuid4
 from tempfile import mkdtemp
-import urllib.request
+import shutil
 
-from yui import YUI
-from yui import YEvent
+# requests, http.client, yui and numpy are imported where they are needed,
+# so that the headless mode starts quickly and does not need libyui
 
 VERSION = 'v.0.5.4'
 IMAGE_TAG = 'tpm2-algtest-ui ' + VERSION
@@ -31,6 +44,7 @@ RESULT_PATH = "/tmp/algtest"
 RUN_ALGTEST_SCRIPT = "/home/dzatovic/tpm2-algtest/run_algtest.py"
 # RUN_ALGTEST_SCRIPT = "run_algtest.py"
 DEPOSITORY_UCO = 4085
+DEPOSITORY_URL = 'https://is.muni.cz/dok/depository_in'
 TCTII = "device:/dev/tpm0"
 INFO_MESSAGE = \
 """<b>Experiment</b>: Analysis of Trusted Platform Modules
@@ -169,15 +183,355 @@ research database now.  Alternatively, you can reboot and upload the archive
 from the USB later.
 """
 
+POPUP_TEXT_CHECKING = """
+Checking the connection to the research database...
+"""
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_RETRIES = 5
+# seconds to wait before the first retry, doubled with every further attempt
+UPLOAD_BACKOFF = 2
+# (connect, read) timeouts of the upload request
+UPLOAD_TIMEOUT = (10, 120)
+
+# storing on the USB and uploading run in parallel
+IO_WORKERS = 2
+
+# upload state of the archives on the result volume
+OUTBOX_NAME = "outbox.json"
+OUTBOX_ARCHIVE_PREFIX = "algtest_result_"
+# the small summary of a run, stored and uploaded next to its archive
+SUMMARY_SUFFIX = "_summary.json"
+# archives uploaded at the same time when the outbox is drained
+OUTBOX_JOBS = 2
+# seconds until a failed archive is tried again, doubled with every further failure
+OUTBOX_BACKOFF = 60
+OUTBOX_MAX_BACKOFF = 3600
+OUTBOX_POLL_INTERVAL = 1
+
+NETWORK_INTERFACES_PATH = "/sys/class/net"
+# seconds
+CONNECTIVITY_TIMEOUT = 5
+CONNECTIVITY_TTL = 60
+CONNECTIVITY_OFFLINE_RETRY = 10
+CONNECTIVITY_WATCH_INTERVAL = 2
+# files are written to the USB in chunks of this size (a multiple of any sane block size)
+DURABLE_WRITE_CHUNK_SIZE = 1024 * 1024
+VERIFY_CHUNK_SIZE = 4 * 1024 * 1024
+USB_WRITE_ATTEMPTS = 3
+CHECKSUMS_NAME = "SHA256SUMS"
+
 SHORT_TEST_ITERATIONS = 1000
 EXTENSIVE_TEST_ITERATIONS = 100000
 
+# the monitor sleeps until output arrives or stop is requested, this is only a
+# safety net in case a grandchild keeps the pipe open after run_algtest exits
+MONITOR_EXIT_CHECK_INTERVAL = 5
+MONITOR_READ_SIZE = 65536
+# the output left after the process exited is read for at most this long
+MONITOR_DRAIN_TIMEOUT = 5
+
+STATUS_REGEX = re.compile(r'(\+\+\+)(.*)(\+\+\+)')
+
+# number of output lines kept in memory, the full output is in RUN_LOG_NAME
+LOG_BUFFER_CAPACITY = 2000
+LOG_VIEW_VISIBLE_LINES = 15
+LOG_VIEW_STORED_LINES = 400
+
+RUN_LOG_NAME = "algtest-ui.log"
+RUN_LOG_FLUSH_INTERVAL = 5
+RUN_LOG_BUFFER_SIZE = 64 * 1024
+
+TIMINGS_NAME = "timings.json"
+
+TIMINGS_SUMMARY_TOP = 10
+TEST_COUNTER_REGEX = re.compile(r'\(([0-9]+)/([0-9]+)\)')
+
+TIMING_HISTORY_NAME = "timing_history.json"
+TIMING_HISTORY_CACHE_DIR = os.path.expanduser("~/.cache/tpm2-algtest-ui")
+# below this fraction of a test done, its own throughput is too noisy to be used alone
+ETA_MIN_FRACTION = 0.02
+# z-score of the reported confidence band (90 %)
+ETA_CONFIDENCE_Z = 1.645
+
+# run_algtest commands which make up the basic ("all") test, run one by one so
+# that an interrupted test can be resumed; the extensive test is not split
+TEST_CATEGORIES = ["capability", "keygen", "perf", "cryptoops", "rng"]
+# run_algtest --help, listing its commands, should not take longer
+ALGTEST_HELP_TIMEOUT = 30
+# next to the output directory, which format archives as a whole
+CHECKPOINT_SUFFIX = "_checkpoint.json"
+
+SESSION_MAGIC = b"ALGTEST-SESSION 1\n"
+# record kind, time in seconds, payload length
+SESSION_RECORD = struct.Struct("<cdI")
+
+# the UI is redrawn at most REFRESH_FRAME_RATE times a second while a test runs,
+# otherwise it waits for user events for REFRESH_IDLE_TIMEOUT ms
+REFRESH_FRAME_RATE = 10
+REFRESH_IDLE_TIMEOUT = 2000
+REFRESH_MIN_TIMEOUT = 10
+# how often the ETA in the snapshot is refreshed while only the progress within a test changes
+SNAPSHOT_ETA_INTERVAL = 1
+# seconds without output after which the test is reported as stalled
+HEARTBEAT_STALL_TIMEOUT = 600
+
+HEADLESS_POLL_INTERVAL = 1
+HEADLESS_JOBS = 4
+HEADLESS_EXIT_SUCCESS = 0
+HEADLESS_EXIT_FAILED = 1
+# 2 is used by argparse for invalid arguments
+HEADLESS_EXIT_STOPPED = 3
+HEADLESS_EXIT_STORE_FAILED = 4
+# from the least to the most severe, several devices exit with the most severe code
+HEADLESS_EXIT_SEVERITY = [HEADLESS_EXIT_SUCCESS, HEADLESS_EXIT_STOPPED, HEADLESS_EXIT_STORE_FAILED,
+                          HEADLESS_EXIT_FAILED]
+
+# categories whose number of repetitions can be set by ITERATIONS_OPTION of run_algtest; not every
+# version of run_algtest has it, algtest_accepts() checks its --help before it is passed
+ITERATED_CATEGORIES = ["keygen", "perf", "cryptoops"]
+ITERATIONS_OPTION = "--num"
+PRECISION_NAME = "precision.json"
+MEASUREMENT_POLL_INTERVAL = 2
+
+# statistics of the measurements computed after the test, needs NumPy
+ANALYSIS_NAME = "analysis.json"
+ANALYSIS_PREFIXES = ("Perf_", "Keygen_", "Cryptoops_")
+# bytes of a CSV file parsed at once, bounds the memory besides the durations themselves
+ANALYSIS_BLOCK_SIZE = 1024 * 1024
+# durations further than this many interquartile ranges from the quartiles are outliers
+ANALYSIS_OUTLIER_IQR = 1.5
+
+# quick checks of the output of the TPM random number generator, needs NumPy
+RNG_NAME = "Rng.bin"
+RNG_CHECK_NAME = "rng_check.json"
+# run_algtest commands which write RNG_NAME
+RNG_CATEGORIES = ["rng", "all", "extensive"]
+# bytes checked at once, bounds the memory of the temporary arrays
+RNG_CHECK_CHUNK_SIZE = 1024 * 1024
+RNG_CHECK_MIN_SIZE = 1024
+# repeated and all-zero blocks are looked for among aligned blocks of this many bytes,
+# the repeated ones within the first RNG_CHECK_MAX_BLOCKS blocks
+RNG_CHECK_BLOCK_SIZE = 16
+RNG_CHECK_MAX_BLOCKS = 1 << 21
+# a statistic further than this many standard deviations from its expected value
+# fails, a good generator fails a test by chance with a probability of about 6e-7
+RNG_CHECK_Z_LIMIT = 5.0
+# an operation is measured precisely enough when the confidence interval of its
+# mean duration is at most ADAPTIVE_TARGET_WIDTH wide relative to the mean
+ADAPTIVE_TARGET_WIDTH = 0.05
+ADAPTIVE_CONFIDENCE_Z = 1.96
+ADAPTIVE_MIN_ITERATIONS = 30
+# seconds per repetition of the iterated categories and per run of the others,
+# rough estimates for TPMs not seen before
+BUDGET_DEFAULT_COSTS = {"capability": 120, "keygen": 2.0, "perf": 0.2, "cryptoops": 0.1, "rng": 300}
+BUDGET_MIN_ITERATIONS = 10
+BUDGET_MAX_ITERATIONS = EXTENSIVE_TEST_ITERATIONS
+# output directories of runs which did not finish yet, on the result volume
+UNFINISHED_RUNS_DIR = "unfinished"
+
+
+# serializes the updates of files shared by the runners of several TPMs
+SHARED_FILES_LOCK = Lock()
+# serializes mounting the result volume, which every runner does on its own
+MOUNT_LOCK = Lock()
+# keeps the JSON lines of the headless mode from interleaving
+EMIT_LOCK = Lock()
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        # some filesystems do not support syncing directories
+        if e.errno != errno.EINVAL:
+            raise
+    finally:
+        os.close(fd)
+
+
+def file_identity(path, known=None):
+    """Return the size, mtime and SHA-256 of the file, hashed only if it changed since known."""
+    stat = os.stat(path)
+    identity = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if known is not None and known.get("sha256") and all(known.get(key) == identity[key] for key in identity):
+        identity["sha256"] = known["sha256"]
+    else:
+        digest = hashlib.sha256()
+        for chunk in read_chunks(path):
+            digest.update(chunk)
+        identity["sha256"] = digest.hexdigest()
+    return identity
+
+
+def read_chunks(path, chunk_size=DURABLE_WRITE_CHUNK_SIZE):
+    """Read the file in chunks of chunk_size, the returned memoryview is reused."""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as source:
+        while True:
+            length = source.readinto(buffer)
+            if not length:
+                return
+            yield view[:length]
+
+
+def durable_write(path, chunks):
+    """Write the chunks to path so that the file is on the disk when this returns.
+
+    The data is written to a temporary file next to path, which is fsynced
+    and atomically renamed to path, then the directory is fsynced as well.
+    Unlike os.sync() only the data of this file is flushed, so this does
+    not wait for other filesystems. Readers never see a partial file.
+
+    Returns the SHA-256 hex digest of the written data.
+    """
+    digest = hashlib.sha256()
+    # unique, several runners may write the same file (e.g. the README) at once
+    tmp_path = "%s.%s.tmp" % (path, uuid4().hex[:8])
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            written = 0
+            while written < len(chunk):
+                written += os.write(fd, chunk[written:])
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
+
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(os.path.abspath(path)))
+    return digest.hexdigest()
+
+
+def durable_copy(source, destination):
+    return durable_write(destination, read_chunks(source))
+
+
+def file_sha256(path, direct=True):
+    """Hash the file as stored on the disk rather than in the page cache.
+
+    The file is read with O_DIRECT into a page-aligned buffer; where the
+    filesystem does not support it, its cached pages are dropped with
+    posix_fadvise() before reading instead.
+    """
+    digest = hashlib.sha256()
+    buffer = mmap.mmap(-1, VERIFY_CHUNK_SIZE)
+    fd = None
+    try:
+        # the open fails with EINVAL too where O_DIRECT is not supported
+        fd = os.open(path, os.O_RDONLY | (os.O_DIRECT if direct else 0))
+        if not direct:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            length = os.readv(fd, [buffer])
+            if not length:
+                break
+            digest.update(memoryview(buffer)[:length])
+    except OSError as e:
+        if not direct or e.errno != errno.EINVAL:
+            raise
+        return file_sha256(path, direct=False)
+    finally:
+        if fd is not None:
+            os.close(fd)
+        buffer.close()
+    return digest.hexdigest()
+
+
+def update_checksums(directory, filename, digest):
+    """Set the checksum of filename in the SHA256SUMS manifest of the directory."""
+    path = os.path.join(directory, CHECKSUMS_NAME)
+    with SHARED_FILES_LOCK:
+        entries = []
+        if os.path.exists(path):
+            with open(path) as checksums_file:
+                entries = [line for line in checksums_file.read().splitlines()
+                           if line and line.split(None, 1)[-1].lstrip("*") != filename]
+        entries.append("%s  %s" % (digest, filename))
+        durable_write(path, ["\n".join(entries).encode("utf-8") + b"\n"])
+
+
+class MultipartFileStream:
+    """File-like multipart/form-data request body streaming the file in chunks.
+
+    The file is never loaded into memory as a whole, its content is read only
+    when the HTTP client asks for the next block. The progress callback gets
+    the number of bytes of the file sent so far and its size.
+    """
+    def __init__(self, fields, file_field, path, progress=None):
+        self.boundary = uuid4().hex
+        self.path = path
+        self.file_size = os.path.getsize(path)
+        self.progress = progress
+
+        before, after = [], []
+        parts = before
+        for name, value in fields:
+            if name == file_field:
+                parts = after
+                continue
+            parts.append(self.part_header(name) + str(value).encode("utf-8") + b"\r\n")
+
+        self.head = b"".join(before) + self.part_header(file_field, os.path.basename(path))
+        self.tail = b"\r\n" + b"".join(after) + b"--" + self.boundary.encode() + b"--\r\n"
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+
+        self.file = None
+        self.position = 0
+
+    def part_header(self, name, filename=None):
+        disposition = 'form-data; name="%s"' % name
+        if filename is not None:
+            disposition += '; filename="%s"\r\nContent-Type: application/octet-stream' % filename
+        return ("--%s\r\nContent-Disposition: %s\r\n\r\n" % (self.boundary, disposition)).encode("utf-8")
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        size = min(size, UPLOAD_CHUNK_SIZE)
+
+        head_end = len(self.head)
+        file_end = head_end + self.file_size
+        if self.position < head_end:
+            block = self.head[self.position:self.position + size]
+        elif self.position < file_end:
+            if self.file is None:
+                self.file = open(self.path, "rb")
+            block = self.file.read(min(size, file_end - self.position))
+            if not block:
+                raise OSError("%s was truncated during the upload" % self.path)
+            if self.progress is not None:
+                self.progress(self.position + len(block) - head_end, self.file_size)
+        else:
+            block = self.tail[self.position - file_end:self.position - file_end + size]
+
+        self.position += len(block)
+        return block
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class UploadRefused(Exception):
+    """The depository refused the file, uploading it again would not help."""
 
 
 class ISUploader:
-    def __init__(self, user_agent, uco):
+    def __init__(self, user_agent, uco, url=DEPOSITORY_URL):
         self.user_agent = user_agent
         self.uco = uco
+        self.url = url
         self.headers = {
             'User-Agent': self.user_agent
         }
@@ -187,27 +541,1572 @@ class ISUploader:
             ('vybos_vzorek', self.uco),
             ('vybos_hledej', 'Vyhledat osobu')
         )
+        self.session = None
+        self.session_lock = Lock()
+        self.last_error = None
+
+    def get_session(self):
+        # the session keeps the connections to the depository alive between uploads and retries,
+        # it is shared by the threads uploading at the same time
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                self.session.headers.update(self.headers)
+            return self.session
+
+    def reset_session(self, session):
+        # start with fresh connections, unless another thread has done so already
+        with self.session_lock:
+            if self.session is session:
+                self.session.close()
+                self.session = None
+
+    def upload(self, filename, description="", mail_text="", progress=None):
+        """Upload the file, return True on success, otherwise keep the error in last_error."""
+        try:
+            self.last_error = None
+            self.try_upload(filename, description, mail_text, progress)
+            return True
+        except (UploadRefused, OSError) as e:
+            self.last_error = str(e)
+        return False
+
+    def try_upload(self, filename, description="", mail_text="", progress=None):
+        """Upload the file, retrying with exponential backoff on network errors.
+
+        The depository does not support partial uploads, so every retry
+        streams the file from its beginning again. Raises UploadRefused if
+        the depository refused the file and OSError if all attempts failed.
+        Unlike upload(), this can be called by several threads at once.
+        """
+        import requests
+
+        error = None
+        for attempt in range(UPLOAD_RETRIES):
+            if attempt:
+                time.sleep(UPLOAD_BACKOFF * 2 ** (attempt - 1))
+            session = self.get_session()
+            try:
+                return self.upload_once(session, filename, description, mail_text, progress)
+            except (requests.RequestException, OSError, ValueError) as e:
+                error = e
+                self.reset_session(session)
+        raise OSError(str(error))
+
+    def upload_once(self, session, filename, description, mail_text, progress):
+        fields = (
+            ('quco', self.uco),
+            ('vlsozav', 'najax'),
+            ('ajax-upload', 'ajax'),
+            ('FILE_1', None),
+            ('A_NAZEV_1', os.path.basename(filename)),
+            ('A_POPIS_1', description),
+            ('TEXT_MAILU', mail_text),
+        )
+        body = MultipartFileStream(fields, 'FILE_1', filename, progress)
+        try:
+            response = session.post(self.url, params=self.params, data=body, timeout=UPLOAD_TIMEOUT,
+                                               headers={'Content-Type': body.content_type})
+        finally:
+            body.close()
+        response.raise_for_status()
+
+        json_response = json.loads(response.content.decode("utf-8"))
+        if json_response.get("uspech") != 1:
+            raise UploadRefused("The depository refused the file: " + response.content.decode("utf-8", errors="replace"))
+        return True
+
+
+def process_owner():
+    """Identify this process, also across reboots, which restart the PIDs."""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as boot_id_file:
+            boot_id = boot_id_file.read().strip()
+    except OSError:
+        boot_id = ""
+    return "%s:%d" % (boot_id, os.getpid())
+
+
+def owner_alive(owner):
+    boot_id, _, pid = owner.rpartition(":")
+    if boot_id != process_owner().rpartition(":")[0]:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except (ProcessLookupError, ValueError):
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        pass
+    return True
+
+
+class UploadOutbox:
+    """Upload state of the result archives on the ALGTEST_RES volume.
+
+    The index (outbox.json next to the archives) maps the file name of
+    every archive and summary to its size, SHA-256 and state. The name
+    alone does not identify the content, a resumed run stores its complete
+    archive under the name of the partial one, so a file which changed is
+    indexed anew whatever the state of the old one. The states are "pending", "uploading" (with the owner process),
+    "uploaded", "refused" by the depository or "incomplete", which is
+    uploaded only when the user asks for it. An archive is uploaded
+    only by the one which claimed it by moving it from "pending" to
+    "uploading", the index is changed under a lock shared with other
+    processes, so an uploaded archive is never uploaded again. Only an upload interrupted by the
+    death of its process is retried, the depository cannot be asked
+    whether it got the file.
+    """
+    def __init__(self, directory=RESULT_PATH):
+        self.directory = directory
+        self.path = os.path.join(directory, OUTBOX_NAME)
+        self.owner = process_owner()
+        self.drain_lock = Lock()
+
+    def available(self):
+        return os.path.isdir(self.directory)
+
+    def load(self):
+        try:
+            with open(self.path) as outbox_file:
+                return json.load(outbox_file)
+        except (OSError, ValueError):
+            return {}
+
+    def update(self, change):
+        """Call change with the entries and store them, return what change returned."""
+        with SHARED_FILES_LOCK, open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self.load()
+            before = json.dumps(entries, sort_keys=True)
+            result = change(entries)
+            if json.dumps(entries, sort_keys=True) != before:
+                durable_write(self.path, [json.dumps(entries, indent=1, sort_keys=True).encode("utf-8")])
+            return result
+
+    def claimable(self, entry, now):
+        if entry["state"] == "uploading":
+            return not owner_alive(entry["owner"])
+        return entry["state"] == "pending" and entry.get("retry_at", 0) <= now
+
+    def identify(self, entries, name, identity):
+        """Record the identity of the file, start over if the entry is of another content."""
+        entry = entries.get(name)
+        if entry is not None and entry.get("sha256") in (None, identity["sha256"]) and \
+                entry.get("size") in (None, identity["size"]):
+            # the same file, or indexed before the identities were recorded
+            entry.update(identity)
+        elif entry is None or entry["state"] != "uploading":
+            entries[name] = dict(identity, state="pending" if self.complete(name) else "incomplete", attempts=0)
+
+    def pending(self):
+        """Add new and changed archives to the index, return the names of those due for an upload."""
+        archives = {name for name in os.listdir(self.directory)
+                    if name.startswith(OUTBOX_ARCHIVE_PREFIX) and name.endswith((".zip", SUMMARY_SUFFIX))}
+        # hashed outside the lock, only the files which changed since they were indexed
+        known = self.load()
+        identities = {}
+        for name in archives:
+            try:
+                identities[name] = file_identity(os.path.join(self.directory, name), known.get(name))
+            except OSError:
+                continue
+
+        def scan(entries):
+            for name, identity in identities.items():
+                self.identify(entries, name, identity)
+            for name in set(entries) - archives:
+                # deleted by the user before it was uploaded
+                if entries[name]["state"] in ("pending", "incomplete"):
+                    del entries[name]
+            now = time.time()
+            return sorted(name for name, entry in entries.items() if self.claimable(entry, now))
+        return self.update(scan)
+
+    def complete(self, name):
+        """Whether the run of the file finished successfully, as far as its summary tells.
+
+        Like the UI, the outbox uploads only complete results by itself.
+        An archive without a summary (of an older version, or of a run
+        whose results could not be formatted) is not known to be complete.
+        """
+        summary = name[:-len(".zip")] + SUMMARY_SUFFIX if name.endswith(".zip") else name
+        try:
+            with open(os.path.join(self.directory, summary)) as summary_file:
+                return json.load(summary_file).get("state") == AlgtestState.SUCCESS.name
+        except (OSError, ValueError):
+            return False
 
-    def upload(self, filename, description="", mail_text=""):
+    def claim(self, name, identity=None, force=False):
+        """Mark the archive as being uploaded by this process, return its state before."""
+        def claim(entries):
+            if identity is not None:
+                self.identify(entries, name, identity)
+            entry = entries.setdefault(name, {"state": "pending", "attempts": 0})
+            state = entry["state"]
+            if self.claimable(entry, time.time()) or (force and state in ("pending", "incomplete")):
+                entry.update(state="uploading", owner=self.owner)
+                return "pending"
+            return state
+        return self.update(claim)
+
+    def finish(self, name, state, error=None):
+        def finish(entries):
+            entry = entries.setdefault(name, {"attempts": 0})
+            entry.update(state=state, attempts=entry["attempts"] + 1, time=round(time.time()))
+            entry.pop("owner", None)
+            entry.pop("retry_at", None)
+            entry.pop("error", None)
+            if error is not None:
+                entry["error"] = error
+            if state == "pending":
+                backoff = OUTBOX_BACKOFF * 2 ** (entry["attempts"] - 1)
+                entry["retry_at"] = round(time.time() + min(backoff, OUTBOX_MAX_BACKOFF))
+        self.update(finish)
+
+    def upload(self, name, uploader, path=None, progress=None, requested=False):
+        """Upload the archive unless it was uploaded already, return its new state.
+
+        An upload requested by the user does not wait for the backoff of
+        the archive, but for its upload by another thread or process to
+        finish. Otherwise "uploading" is returned in that case.
+        """
+        path = path or os.path.join(self.directory, name)
+        try:
+            identity = file_identity(path, self.load().get(name))
+        except OSError:
+            identity = None
+        while True:
+            state = self.claim(name, identity, force=requested)
+            if state != "uploading" or not requested:
+                break
+            time.sleep(OUTBOX_POLL_INTERVAL)
+        if state != "pending":
+            return state
+
+        error = None
+        try:
+            uploader.try_upload(path, progress=progress)
+            state = "uploaded"
+        except UploadRefused as e:
+            state, error = "refused", str(e)
+        except OSError as e:
+            state, error = "pending", str(e)
+        except BaseException:
+            self.finish(name, "pending", "interrupted")
+            raise
+        self.finish(name, state, error)
+        return state
+
+    def drain(self, uploader, jobs=OUTBOX_JOBS):
+        """Upload the pending files, return their new states by name.
+
+        All summaries are uploaded before the first archive, so that they
+        arrive even if the archives take long or fail. Returns None if the
+        outbox is being drained by another thread of this process already.
+        """
+        if not self.available() or not self.drain_lock.acquire(blocking=False):
+            return None
+        try:
+            names = self.pending()
+            results = {}
+            with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="AlgtestOutbox") as pool:
+                for tier in ([name for name in names if name.endswith(SUMMARY_SUFFIX)],
+                             [name for name in names if not name.endswith(SUMMARY_SUFFIX)]):
+                    results.update(zip(tier, pool.map(lambda name: self.upload(name, uploader), tier)))
+            return results
+        finally:
+            self.drain_lock.release()
+
+
+class LogBuffer:
+    """Fixed-capacity ring buffer of log lines addressed by sequence numbers.
+
+    Readers keep a cursor (the sequence number of the next line they want) and
+    fetch only the lines appended since.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lines = [None] * capacity
+        self.next_seq = 0
+        self.lock = Lock()
+
+    def append(self, lines):
+        with self.lock:
+            for line in lines:
+                self.lines[self.next_seq % self.capacity] = line
+                self.next_seq += 1
+
+    def since(self, cursor):
+        """Return the new cursor and the lines appended since cursor.
+
+        Lines which were already evicted from the buffer are skipped.
+        """
+        with self.lock:
+            start = max(cursor, self.next_seq - self.capacity)
+            return self.next_seq, [self.lines[seq % self.capacity] for seq in range(start, self.next_seq)]
+
+    def tail(self, count=None):
+        with self.lock:
+            cursor = self.next_seq - min(count or self.capacity, self.capacity)
+        return self.since(max(cursor, 0))[1]
+
+
+class RunLog:
+    """Append-only log of the whole run stored in the output directory.
+
+    Writes are buffered and flushed at most every RUN_LOG_FLUSH_INTERVAL
+    seconds, status changes are flushed immediately. The file is (re)opened
+    lazily, so writing after close() appends to it again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+    def write(self, lines, flush=False):
+        timestamp = datetime.datetime.now().isoformat(sep=" ", timespec="milliseconds")
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a", buffering=RUN_LOG_BUFFER_SIZE)
+            for line in lines:
+                self.file.write(timestamp + " " + line + "\n")
+
+            now = time.monotonic()
+            if flush or now - self.last_flush >= RUN_LOG_FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def write_status(self, status):
+        self.write(["+++ " + status], flush=True)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class SessionRecorder:
+    """Records the raw output of the run_algtest processes with their timing.
+
+    The session file is a gzip stream of SESSION_MAGIC followed by records
+    of a SESSION_RECORD header (kind, time, payload length) and the payload.
+    The kinds are P (process started, JSON of the command), O (output), X
+    (process exited, the return code) and F (file the runner reads from the
+    output directory, its name, NUL and content). The time of O and X
+    records is relative to the start of their process. The records are
+    compressed and written by a thread of their own, so the runner only
+    queues them while it monitors the output.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wb")
+        self.file.write(SESSION_MAGIC)
+        self.origin = time.monotonic()
+        self.process_start = self.origin
+        self.records = queue.SimpleQueue()
+        self.writer = Thread(target=self.write, name="SessionRecorder", daemon=True)
+        self.writer.start()
+
+    def write(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            for data in record:
+                self.file.write(data)
+
+    def record(self, kind, offset, payload):
+        self.records.put((SESSION_RECORD.pack(kind, offset, len(payload)), payload))
+
+    def start_process(self, cmd):
+        self.process_start = time.monotonic()
+        self.record(b"P", self.process_start - self.origin, json.dumps(cmd).encode("utf-8"))
+
+    def output(self, chunk):
+        if chunk:
+            self.record(b"O", time.monotonic() - self.process_start, chunk)
+
+    def exit(self, returncode):
+        self.record(b"X", time.monotonic() - self.process_start, str(returncode).encode("ascii"))
+
+    def add_file(self, out_dir, name):
         try:
-            files = {
-                'quco': (None, self.uco),
-                'vlsozav': (None, 'najax'),
-                'ajax-upload': (None, 'ajax'),
-                'FILE_1': (filename, open(filename, 'rb')),
-                'A_NAZEV_1': (None, filename),
-                'A_POPIS_1': (None, description),
-                'TEXT_MAILU': (None, mail_text),
-            }
-
-            response = requests.post('https://is.muni.cz/dok/depository_in', headers=self.headers, params=self.params, files=files)
-            json_response = json.loads(response.content.decode("utf-8"))
-            if json_response["uspech"] != 1:
+            with open(os.path.join(out_dir, name), "rb") as recorded_file:
+                content = recorded_file.read()
+        except OSError:
+            return
+        self.record(b"F", time.monotonic() - self.origin, name.encode("utf-8") + b"\0" + content)
+
+    def close(self, out_dir):
+        # the TPM properties identify the TPM, so the replay uses the same timing history
+        for name in ("Capability_properties-fixed.txt", os.path.join("detail", "Capability_properties-fixed.txt")):
+            self.add_file(out_dir, name)
+        self.records.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+class ReplayProcess:
+    """Plays back the output of a recorded process in place of subprocess.Popen.
+
+    The output is written into a pipe by a feeder thread at the recorded
+    times divided by speed, or as fast as possible if speed is 0, so the
+    runner reads it exactly like the output of a real process.
+    """
+    def __init__(self, cmd, chunks, exit_offset, returncode, speed):
+        self.cmd = cmd
+        self.chunks = chunks
+        self.exit_offset = exit_offset
+        self.recorded_returncode = returncode
+        self.speed = speed
+        # there is no process, so the profiler records no CPU time
+        self.pid = -1
+        self.returncode = None
+        self.exited = Event()
+        self.terminated = Event()
+
+        read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.write_fd, False)
+        self.stdout = os.fdopen(read_fd, "rb")
+        self.feeder = Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    def sleep_until(self, start, offset):
+        if not self.speed:
+            return not self.terminated.is_set()
+        delay = start + offset / self.speed - time.monotonic()
+        return not self.terminated.wait(max(delay, 0))
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.terminated.is_set():
                 return False
-        except:
+            try:
+                view = view[os.write(self.write_fd, view):]
+            except BlockingIOError:
+                # the pipe is full, wait until the runner reads it
+                select.select([], [self.write_fd], [], MONITOR_EXIT_CHECK_INTERVAL)
+        return True
+
+    def feed(self):
+        start = time.monotonic()
+        try:
+            for offset, chunk in self.chunks:
+                if not self.sleep_until(start, offset) or not self.write(chunk):
+                    break
+            else:
+                self.sleep_until(start, self.exit_offset)
+        finally:
+            os.close(self.write_fd)
+            self.returncode = -signal.SIGTERM if self.terminated.is_set() else self.recorded_returncode
+            self.exited.set()
+
+    def poll(self):
+        return self.returncode if self.exited.is_set() else None
+
+    def wait(self):
+        self.exited.wait()
+        return self.returncode
+
+    def terminate(self):
+        self.terminated.set()
+
+
+class SessionReplay:
+    """Recorded session, popen() returns its processes in the recorded order."""
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.processes = deque()
+        self.files = []
+
+        with gzip.open(path, "rb") as session_file:
+            if session_file.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+                raise ValueError("%s is not a recorded session" % path)
+            process = None
+            while True:
+                header = session_file.read(SESSION_RECORD.size)
+                if len(header) < SESSION_RECORD.size:
+                    break
+                kind, offset, length = SESSION_RECORD.unpack(header)
+                payload = session_file.read(length)
+                if kind == b"P":
+                    process = {"cmd": json.loads(payload), "chunks": [], "exit_offset": 0.0, "returncode": None}
+                    self.processes.append(process)
+                elif kind == b"O" and process is not None:
+                    process["chunks"].append((offset, payload))
+                elif kind == b"X" and process is not None:
+                    process["exit_offset"] = offset
+                    process["returncode"] = int(payload)
+                elif kind == b"F":
+                    name, _, content = payload.partition(b"\0")
+                    self.files.append((name.decode("utf-8"), content))
+
+    def remaining(self):
+        return len(self.processes)
+
+    def restore_files(self, out_dir):
+        files, self.files = self.files, []
+        for name, content in files:
+            path = os.path.join(out_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as restored_file:
+                restored_file.write(content)
+
+    def popen(self, cmd):
+        if not self.processes:
+            # the runner went a different way than in the recorded session
+            return ReplayProcess(cmd, [], 0.0, 1, self.speed)
+        process = self.processes.popleft()
+        # a process killed before the end of the recording did not record its exit
+        returncode = process["returncode"] if process["returncode"] is not None else -signal.SIGTERM
+        return ReplayProcess(process["cmd"], process["chunks"], process["exit_offset"], returncode, self.speed)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh %02dm %02ds" % (hours, minutes, seconds)
+    return "%dm %02ds" % (minutes, seconds)
+
+
+def process_cpu_time(pid):
+    """CPU time in seconds used by the process and its already waited-for children."""
+    try:
+        with open("/proc/%d/stat" % pid) as stat_file:
+            # skip pid and the command name, which may contain spaces
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    # utime, stime, cutime and cstime are fields 14-17 of the stat file
+    return sum(int(ticks) for ticks in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+
+class PhaseProfiler:
+    """Records wall-clock time, output lines and CPU time of each test phase.
+
+    A phase starts with a +++status+++ marker and ends with the next marker
+    or when the profiled process finishes. Lines printed before the first
+    marker are accounted to a phase named after the run_algtest command.
+    The phases are summed up by that command, their category.
+    """
+    def __init__(self):
+        self.started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        self.origin = time.monotonic()
+        self.phases = []
+        self.current = None
+        self.pid = None
+        self.command = None
+
+    def load(self, path):
+        """Continue the timings of a resumed run."""
+        try:
+            with open(path) as timings_file:
+                timings = json.load(timings_file)
+        except (OSError, ValueError):
+            return
+        self.started_at = timings["started_at"]
+        self.phases = timings["phases"]
+        if self.phases:
+            self.origin = time.monotonic() - self.phases[-1]["end"]
+
+    def start(self, pid, command):
+        self.pid = pid
+        self.command = command
+        self.begin(command)
+
+    def begin(self, name):
+        if self.pid is None:
+            return
+        self.end()
+        match = TEST_COUNTER_REGEX.search(name)
+        self.current = {
+            "name": name,
+            "category": self.command,
+            "start": time.monotonic() - self.origin,
+            "cpu_start": process_cpu_time(self.pid),
+            "lines": 0,
+        }
+        if match:
+            self.current["test"] = int(match.group(1))
+            self.current["tests"] = int(match.group(2))
+
+    def count_line(self):
+        if self.current is not None:
+            self.current["lines"] += 1
+
+    def end(self):
+        if self.current is None:
+            return
+        phase = self.current
+        self.current = None
+
+        phase["end"] = time.monotonic() - self.origin
+        phase["duration"] = phase["end"] - phase["start"]
+        cpu_start = phase.pop("cpu_start")
+        cpu_end = process_cpu_time(self.pid)
+        phase["cpu_time"] = cpu_end - cpu_start if None not in (cpu_start, cpu_end) else None
+        self.phases.append(phase)
+
+    def finish(self):
+        """End the current phase, must be called before the process is reaped."""
+        self.end()
+        self.pid = None
+
+    def categories(self):
+        durations = {}
+        for phase in self.phases:
+            durations[phase["category"]] = durations.get(phase["category"], 0) + phase["duration"]
+        return sorted(durations.items(), key=lambda item: item[1], reverse=True)
+
+    def write(self, path):
+        with open(path, "w") as timings_file:
+            json.dump({
+                "started_at": self.started_at,
+                "total_duration": sum(phase["duration"] for phase in self.phases),
+                "categories": dict(self.categories()),
+                "phases": self.phases,
+            }, timings_file, indent=1)
+
+    def summary(self, top=TIMINGS_SUMMARY_TOP):
+        total = sum(phase["duration"] for phase in self.phases) or 1
+        lines = ["Slowest test phases:"]
+        for category, duration in self.categories()[:top]:
+            lines.append("%12s %5.1f%%  %s" % (format_duration(duration), 100 * duration / total, category))
+        return "\n".join(lines)
+
+
+def find_result_file(out_dir, name):
+    for directory in (out_dir, os.path.join(out_dir, 'detail')):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_tpm_properties(out_dir):
+    """Parse the fixed TPM properties gathered by run_algtest, if already present."""
+    properties = {}
+    path = find_result_file(out_dir, "Capability_properties-fixed.txt")
+    if path is None:
+        return properties
+
+    name = None
+    with open(path, errors="replace") as properties_file:
+        for line in properties_file:
+            if not line.startswith((" ", "\t")) and line.rstrip().endswith(":"):
+                name = line.strip()[:-1]
+            elif name is not None and ":" in line:
+                key, value = line.strip().split(":", 1)
+                # prefer the decoded value over the raw one
+                if key == "value" or name not in properties:
+                    properties[name] = value.strip().strip('"')
+    return properties
+
+
+def read_capability_names(out_dir, filename):
+    """Return the names of the algorithms or commands listed by run_algtest."""
+    path = find_result_file(out_dir, filename)
+    if path is None:
+        return []
+    with open(path, errors="replace") as capability_file:
+        return [line.strip()[:-1] for line in capability_file
+                if not line.startswith((" ", "\t")) and line.rstrip().endswith(":")]
+
+
+def timing_history_path():
+    if result_path_mounted():
+        return os.path.join(RESULT_PATH, TIMING_HISTORY_NAME)
+    return os.path.join(TIMING_HISTORY_CACHE_DIR, TIMING_HISTORY_NAME)
+
+
+class TimingHistory:
+    """Test durations from earlier runs, keyed by the TPM manufacturer and firmware.
+
+    For every test, identified by its category and "n/m" position, and for
+    every category as a whole, the name, mean and variance of the duration
+    and the number of runs are stored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tpms = {}
+        self.changed = set()
+        try:
+            with open(path) as history_file:
+                self.tpms = json.load(history_file)
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, tpm_id, test):
+        entry = self.tpms.get(tpm_id, {}).get(test)
+        if entry is None:
+            return None
+        _, mean, variance, _ = entry
+        return mean, variance
+
+    def record(self, tpm_id, test, name, duration):
+        tests = self.tpms.setdefault(tpm_id, {})
+        _, mean, variance, count = tests.get(test, (name, 0.0, 0.0, 0))
+        # Welford's online update of the mean and the population variance
+        count += 1
+        delta = duration - mean
+        mean += delta / count
+        variance += (delta * (duration - mean) - variance) / count
+        tests[test] = [name, round(mean, 1), round(variance, 1), count]
+        self.changed.add(tpm_id)
+
+    def save(self):
+        # other runners may have saved their TPMs since this history was loaded
+        with SHARED_FILES_LOCK:
+            tpms = TimingHistory(self.path).tpms
+            for tpm_id in self.changed:
+                tpms.setdefault(tpm_id, {}).update(self.tpms[tpm_id])
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as history_file:
+                json.dump(tpms, history_file, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+
+
+class P2Quantile:
+    """Streaming estimate of a quantile in constant memory.
+
+    This is the P-square algorithm of Jain and Chlamtac, five markers are
+    moved along the stream and their heights adjusted by piecewise-parabolic
+    interpolation.
+    """
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        heights, positions = self.heights, self.positions
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            delta = self.desired[i] - positions[i]
+            if (delta >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (delta <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if delta > 0 else -1
+                height = heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i]) +
+                    (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1]))
+                if not heights[i - 1] < height < heights[i + 1]:
+                    # fall back to linear interpolation
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[round(self.quantile * (len(self.heights) - 1))]
+        return self.heights[2]
+
+
+class StreamingStats:
+    """Mean and variance (Welford's algorithm) and quantiles of a stream of measurements."""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.quantiles = {quantile: P2Quantile(quantile) for quantile in (0.5, 0.95)}
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        for quantile in self.quantiles.values():
+            quantile.add(value)
+
+    def stdev(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else None
+
+    def ci_relative_width(self):
+        """Width of the confidence interval of the mean relative to the mean."""
+        if self.count < 2 or self.mean == 0:
+            return None
+        return 2 * ADAPTIVE_CONFIDENCE_Z * self.stdev() / self.count ** 0.5 / abs(self.mean)
+
+    def required_samples(self, target):
+        """Number of samples needed for the confidence interval to be target wide."""
+        if self.count < 2 or self.mean == 0:
+            return None
+        return int((2 * ADAPTIVE_CONFIDENCE_Z * self.stdev() / (target * abs(self.mean))) ** 2) + 1
+
+    def summary(self, target):
+        width = self.ci_relative_width()
+        return {
+            "samples": self.count,
+            "mean": self.mean,
+            "stdev": self.stdev(),
+            "median": self.quantiles[0.5].value(),
+            "p95": self.quantiles[0.95].value(),
+            "ci_relative_width": width,
+            "required_samples": self.required_samples(target),
+            "converged": width is not None and width <= target and self.count >= ADAPTIVE_MIN_ITERATIONS,
+        }
+
+
+class MeasurementMonitor:
+    """Follows the CSV files with measurements while run_algtest writes them.
+
+    Every CSV file in the detail directory with a duration column is one
+    stream of measurements of a single operation. The files are read
+    incrementally from the last offset, so polling them is cheap.
+    """
+    def __init__(self, detail_dir):
+        self.detail_dir = detail_dir
+        self.streams = {}
+        self.categories = {}
+        self.columns = {}
+        self.offsets = {}
+        self.partial_lines = {}
+        self.last_poll = 0
+
+    def poll(self, category=None, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_poll < MEASUREMENT_POLL_INTERVAL:
+            return
+        self.last_poll = now
+        try:
+            names = os.listdir(self.detail_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith(".csv") and self.columns.get(name, 0) is not None:
+                self.read(name, category)
+
+    def read(self, name, category):
+        path = os.path.join(self.detail_dir, name)
+        offset = self.offsets.get(name, 0)
+        try:
+            if os.path.getsize(path) < offset:
+                # the file was rewritten
+                offset = 0
+                self.partial_lines.pop(name, None)
+                self.columns.pop(name, None)
+                self.streams.pop(name, None)
+            with open(path, "rb") as csv_file:
+                csv_file.seek(offset)
+                data = csv_file.read()
+        except OSError:
+            return
+        self.offsets[name] = offset + len(data)
+
+        lines = (self.partial_lines.get(name, b"") + data).split(b"\n")
+        self.partial_lines[name] = lines.pop()
+        for line in lines:
+            fields = line.decode("ascii", errors="replace").strip().split(",")
+            if name not in self.columns:
+                # the first line is the header, only files with durations are followed
+                columns = [i for i, field in enumerate(fields) if "duration" in field.lower()]
+                self.columns[name] = columns[0] if columns else None
+                if self.columns[name] is None:
+                    return
+                self.streams[name] = StreamingStats()
+                self.categories[name] = category
+                continue
+            try:
+                self.streams[name].add(float(fields[self.columns[name]]))
+            except (ValueError, IndexError):
+                continue
+
+    def required_samples(self, category, target):
+        required = [stats.required_samples(target) for name, stats in self.streams.items()
+                    if self.categories[name] == category]
+        required = [samples for samples in required if samples is not None]
+        return max(required) if required else None
+
+    def summary(self, target):
+        return {name: dict(stats.summary(target), category=self.categories[name])
+                for name, stats in sorted(self.streams.items())}
+
+
+def parse_duration_block(numpy, block, column):
+    """Return the durations in the column of the complete CSV lines in block."""
+    lines = block.decode("ascii", errors="replace").splitlines()
+    try:
+        # only the duration column is converted, the other ones (e.g. keys in hex) are skipped
+        return numpy.loadtxt(lines, delimiter=",", usecols=column, comments=None, ndmin=1)
+    except ValueError:
+        # a malformed or incomplete line, e.g. of an interrupted test, parse the block line by line
+        values = []
+        for line in lines:
+            try:
+                values.append(float(line.split(",")[column]))
+            except (ValueError, IndexError):
+                continue
+        return numpy.array(values, dtype=float)
+
+
+def read_durations(numpy, path):
+    """Return the durations in the CSV file as an array, None if it has no duration column.
+
+    The file is parsed in blocks of ANALYSIS_BLOCK_SIZE bytes and only the
+    durations are kept, 8 bytes per row, so even the files of the
+    extensive test take little memory.
+    """
+    with open(path, "rb") as csv_file:
+        header = csv_file.readline().decode("ascii", errors="replace").strip().split(",")
+        columns = [i for i, field in enumerate(header) if "duration" in field.lower()]
+        if not columns:
+            return None
+        parts = []
+        rest = b""
+        while True:
+            block = csv_file.read(ANALYSIS_BLOCK_SIZE)
+            data = rest + block
+            if block:
+                end = data.rfind(b"\n") + 1
+                data, rest = data[:end], data[end:]
+            if data.strip():
+                parts.append(parse_duration_block(numpy, data, columns[0]))
+            if not block:
+                break
+    return numpy.concatenate(parts) if parts else numpy.empty(0)
+
+
+def duration_statistics(numpy, durations):
+    q1, median, q3, p95, p99 = numpy.percentile(durations, [25, 50, 75, 95, 99])
+    fence = ANALYSIS_OUTLIER_IQR * (q3 - q1)
+    total = float(durations.sum())
+    return {
+        "samples": int(durations.size),
+        "mean": total / durations.size,
+        "median": float(median),
+        "p95": float(p95),
+        "p99": float(p99),
+        "min": float(durations.min()),
+        "max": float(durations.max()),
+        "outliers": int(numpy.count_nonzero((durations < q1 - fence) | (durations > q3 + fence))),
+        "throughput": durations.size / total if total > 0 else None,
+    }
+
+
+def analyze_measurements(detail_dir):
+    """Compute the statistics of the durations of every measured operation.
+
+    Returns them by the name of the CSV file without the extension, or
+    None if NumPy is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    analysis = {}
+    try:
+        names = sorted(os.listdir(detail_dir))
+    except FileNotFoundError:
+        return analysis
+    for name in names:
+        if not name.startswith(ANALYSIS_PREFIXES) or not name.endswith(".csv"):
+            continue
+        durations = read_durations(numpy, os.path.join(detail_dir, name))
+        durations = durations[numpy.isfinite(durations)] if durations is not None else None
+        if durations is not None and durations.size:
+            analysis[name[:-len(".csv")]] = duration_statistics(numpy, durations)
+    return analysis
+
+
+def format_analysis(analysis):
+    """Format the statistics of the measurements as a table, the durations in ms."""
+    lines = ["%-40s %8s %9s %9s %9s %9s %8s %10s" % ("Operation", "Samples", "Mean", "Median", "p95", "p99",
+                                                       "Outliers", "Ops/s")]
+    for name, stats in analysis.items():
+        lines.append("%-40s %8d %9.3f %9.3f %9.3f %9.3f %8d %10s" % (
+            name, stats["samples"], 1e3 * stats["mean"], 1e3 * stats["median"], 1e3 * stats["p95"],
+            1e3 * stats["p99"], stats["outliers"],
+            "%.1f" % stats["throughput"] if stats["throughput"] is not None else "-"))
+    return "\n".join(lines)
+
+
+def check_rng_output(path):
+    """Check whether the output of the TPM random number generator looks random.
+
+    A quick battery, not a replacement of the analysis of the data: the
+    chi-square test of the byte histogram, the monobit and runs tests of
+    NIST SP 800-22 and a search for repeated and all-zero blocks. The
+    file is memory-mapped and processed in chunks of RNG_CHECK_CHUNK_SIZE,
+    the histogram also gives the number of ones and of the bit changes
+    within the bytes. Returns the verdict ("PASS" or "FAIL"), the failures
+    and the statistics, or None if NumPy is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    size = os.path.getsize(path)
+    if size < RNG_CHECK_MIN_SIZE:
+        return {"verdict": "FAIL", "failures": ["truncated, only %d bytes" % size], "size": size}
+
+    values = numpy.arange(256, dtype=numpy.uint8)
+    ones_in_byte = numpy.unpackbits(values[:, None], axis=1).sum(axis=1).astype(numpy.int64)
+    # bit changes between the neighbouring bits of the byte, most significant bit first
+    changes_in_byte = ones_in_byte[(values ^ (values >> 1)) & 0x7f]
+
+    histogram = numpy.zeros(256, dtype=numpy.int64)
+    changes = zero_blocks = 0
+    with open(path, "rb") as rng_file, mmap.mmap(rng_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        data = numpy.frombuffer(mapped, dtype=numpy.uint8)
+        last = None
+        for start in range(0, size, RNG_CHECK_CHUNK_SIZE):
+            chunk = data[start:start + RNG_CHECK_CHUNK_SIZE]
+            histogram += numpy.bincount(chunk, minlength=256)
+            # the changes between the last bit of a byte and the first bit of the next one
+            changes += int(numpy.count_nonzero((chunk[:-1] & 1) != (chunk[1:] >> 7)))
+            if last is not None:
+                changes += int((last & 1) != (chunk[0] >> 7))
+            last = chunk[-1]
+            blocks = chunk[:len(chunk) // RNG_CHECK_BLOCK_SIZE * RNG_CHECK_BLOCK_SIZE].view(numpy.uint64)
+            zero_blocks += int(numpy.count_nonzero(~blocks.reshape(-1, RNG_CHECK_BLOCK_SIZE // 8).any(axis=1)))
+
+        # of random 64-bit keys, some equal with a probability of about 1e-7 even for RNG_CHECK_MAX_BLOCKS
+        count = min(size // RNG_CHECK_BLOCK_SIZE, RNG_CHECK_MAX_BLOCKS)
+        keys = numpy.sort(data[:count * RNG_CHECK_BLOCK_SIZE].view(numpy.uint64)[::RNG_CHECK_BLOCK_SIZE // 8])
+        repeated_blocks = int(numpy.count_nonzero(keys[1:] == keys[:-1]))
+        # the views must be released before the file is unmapped
+        del data, chunk, blocks, keys
+
+    bits = 8 * size
+    ones = int(histogram @ ones_in_byte)
+    changes += int(histogram @ changes_in_byte)
+    expected = size / 256
+    chi_square = float(((histogram - expected) ** 2).sum() / expected)
+    # Wilson-Hilferty approximation of the chi-square distribution with 255 degrees of freedom
+    df = 255
+    chi_square_z = ((chi_square / df) ** (1 / 3) - (1 - 2 / (9 * df))) / (2 / (9 * df)) ** 0.5
+    monobit_z = (2 * ones - bits) / bits ** 0.5
+    fraction = ones / bits
+    if 0 < fraction < 1:
+        # the standard normal z, NIST divides it by sqrt(2) more to pass it to erfc
+        runs_z = (changes + 1 - 2 * bits * fraction * (1 - fraction)) / \
+            (2 * bits ** 0.5 * fraction * (1 - fraction))
+    else:
+        runs_z = float("inf")
+
+    failures = []
+    for name, z in (("byte distribution", chi_square_z), ("monobit", monobit_z), ("runs", runs_z)):
+        if abs(z) > RNG_CHECK_Z_LIMIT:
+            failures.append("%s (z = %.1f)" % (name, z))
+    if repeated_blocks:
+        failures.append("%d repeated blocks" % repeated_blocks)
+    if zero_blocks:
+        failures.append("%d all-zero blocks" % zero_blocks)
+    return {
+        "verdict": "FAIL" if failures else "PASS",
+        "failures": failures,
+        "size": size,
+        "chi_square": chi_square,
+        "chi_square_z": chi_square_z,
+        "monobit_z": monobit_z,
+        "runs_z": runs_z,
+        "repeated_blocks": repeated_blocks,
+        "checked_blocks": count,
+        "zero_blocks": zero_blocks,
+    }
+
+
+def format_rng_check(rng_check):
+    if rng_check["verdict"] == "PASS":
+        return "RNG output check: PASS (%.1f MB, z: byte distribution %.1f, monobit %.1f, runs %.1f)" % (
+            rng_check["size"] / 2**20, rng_check["chi_square_z"], rng_check["monobit_z"], rng_check["runs_z"])
+    return "RNG output check: FAIL, " + ", ".join(rng_check["failures"])
+
+
+class EtaEstimator:
+    """Estimates the remaining time of the run from the progress of each test.
+
+    The remaining time of the current test is extrapolated from its own
+    throughput and blended with the duration expected from earlier runs on
+    the same TPM, the weight of the measured throughput grows with the
+    fraction of the test done. Tests not started yet use their duration from
+    the history, or the mean duration of the tests finished so far in this
+    run (or the projected duration of the current test if there is none).
+    Test categories not started yet use their total duration from the
+    history, or the projected duration of the current category. The
+    variances of the individual estimates are summed up into a confidence
+    band.
+    """
+    def __init__(self, history=None):
+        self.history = history
+        self.tpm_id = None
+        self.category = None
+        self.category_start = None
+        self.categories_left = []
+        self.test = None
+        self.test_name = None
+        self.test_start = None
+        self.fraction = 0
+        self.durations = {}
+        self.category_durations = {}
+
+    def begin_category(self, category, categories_left, now=None):
+        now = time.monotonic() if now is None else now
+        self.end_category(now)
+        self.category = category
+        self.category_start = now
+        self.categories_left = list(categories_left)
+
+    def end_category(self, now=None):
+        if self.category is None:
+            return
+        now = time.monotonic() if now is None else now
+        self.end(now)
+        self.category_durations["category " + self.category] = (self.category, now - self.category_start)
+        self.category = None
+
+    def test_key(self, current, total):
+        return "%s %d/%d" % (self.category, current, total)
+
+    def begin(self, name, now=None):
+        match = TEST_COUNTER_REGEX.search(name)
+        if not match or self.category is None:
+            return
+        now = time.monotonic() if now is None else now
+        self.end(now)
+        self.test = (int(match.group(1)), int(match.group(2)))
+        self.test_name = TEST_COUNTER_REGEX.sub("", name).strip()
+        self.test_start = now
+        self.fraction = 0
+
+    def progress(self, fraction):
+        self.fraction = fraction
+
+    def end(self, now=None):
+        if self.test is None:
+            return
+        now = time.monotonic() if now is None else now
+        self.durations[self.test_key(*self.test)] = (self.test_name, now - self.test_start)
+        self.test = None
+
+    def from_history(self, key):
+        if self.history is None or self.tpm_id is None:
+            return None
+        return self.history.lookup(self.tpm_id, key)
+
+    def expected_duration(self, key, projected=None):
+        expected = self.from_history(key)
+        if expected is not None:
+            return expected
+
+        durations = [duration for _, duration in self.durations.values()]
+        if not durations:
+            durations = [projected] if projected is not None else []
+        if not durations:
+            return None
+        mean = sum(durations) / len(durations)
+        if len(durations) == 1:
+            # a single sample says nothing about the spread, assume it is large
+            return mean, mean ** 2
+        return mean, sum((duration - mean) ** 2 for duration in durations) / (len(durations) - 1)
+
+    def estimate(self, now=None):
+        """Return the expected remaining time and its confidence band in seconds."""
+        if self.test is None:
+            return None
+        now = time.monotonic() if now is None else now
+        current, total = self.test
+        elapsed = now - self.test_start
+
+        remaining, variance, projected = 0.0, 0.0, None
+        expected = self.expected_duration(self.test_key(current, total))
+        if expected is not None:
+            mean, expected_variance = expected
+            remaining, variance = max(mean - elapsed, 0.0), expected_variance
+        if self.fraction >= ETA_MIN_FRACTION:
+            projected = elapsed / self.fraction
+            measured = projected - elapsed
+            measured_variance = (measured * (1 - self.fraction)) ** 2
+            if expected is None:
+                remaining, variance = measured, measured_variance
+            else:
+                remaining = self.fraction * measured + (1 - self.fraction) * remaining
+                variance = self.fraction * measured_variance + (1 - self.fraction) * variance
+        elif expected is None:
+            return None
+
+        for test in range(current + 1, total + 1):
+            expected = self.expected_duration(self.test_key(test, total), projected)
+            if expected is None:
+                return None
+            remaining += expected[0]
+            variance += expected[1]
+
+        category_projected = now - self.category_start + remaining
+        for category in self.categories_left:
+            expected = self.from_history("category " + category) or (category_projected, category_projected ** 2)
+            remaining += expected[0]
+            variance += expected[1]
+
+        return remaining, ETA_CONFIDENCE_Z * variance ** 0.5
+
+    def record_history(self):
+        if self.history is None or self.tpm_id is None:
+            return
+        for key, (name, duration) in list(self.durations.items()) + list(self.category_durations.items()):
+            self.history.record(self.tpm_id, key, name, duration)
+        self.history.save()
+
+
+class TimeBudgetPlanner:
+    """Splits a wall-clock time budget among the test categories.
+
+    Categories with a fixed amount of work are expected to take as long as
+    before, the rest of the budget is split evenly among the categories
+    with a configurable number of repetitions. Costs come from earlier runs
+    on the same TPM or from the defaults, scaled by the ratio of the
+    observed to the expected durations of the categories already finished.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.costs = dict(BUDGET_DEFAULT_COSTS)
+        self.observed = 0.0
+        self.expected = 0.0
+        self.plan = {}
+
+    def load(self, history, tpm_id):
+        if history is None or tpm_id is None:
+            return
+        for category in self.costs:
+            prefix = "repetition " if category in ITERATED_CATEGORIES else "category "
+            entry = history.lookup(tpm_id, prefix + category)
+            if entry is not None and entry[0] > 0:
+                self.costs[category] = entry[0]
+
+    def correction(self):
+        return self.observed / self.expected if self.expected > 0 else 1.0
+
+    def cost(self, category, iterations=None):
+        cost = self.costs.get(category, 0.0)
+        if category in ITERATED_CATEGORIES:
+            cost *= iterations or 0
+        return cost * self.correction()
+
+    def replan(self, elapsed, categories):
+        """Compute the number of repetitions for each of the remaining categories."""
+        iterated = [category for category in categories if category in ITERATED_CATEGORIES]
+        fixed = sum(self.cost(category) for category in categories if category not in ITERATED_CATEGORIES)
+        available = max(self.budget - elapsed - fixed, 0.0)
+        self.plan = {}
+        for category in iterated:
+            repetition = self.cost(category, 1)
+            iterations = int(available / len(iterated) / repetition) if repetition > 0 else BUDGET_MAX_ITERATIONS
+            self.plan[category] = min(max(iterations, BUDGET_MIN_ITERATIONS), BUDGET_MAX_ITERATIONS)
+        return self.plan
+
+    def observe(self, category, duration, iterations=None):
+        self.expected += self.costs.get(category, 0.0) * (iterations or 1)
+        self.observed += duration
+
+    def describe(self, categories):
+        return ", ".join("%s %s" % (category, "%d repetitions" % self.plan[category] if category in self.plan
+                                    else format_duration(self.cost(category)))
+                         for category in categories)
+
+
+def result_path_mounted():
+    # mount_result_path() creates the mount point even if mounting fails
+    return os.path.ismount(RESULT_PATH)
+
+
+def mount_result_path():
+    """Mount the ALGTEST_RES volume, return True if it was mounted by this call."""
+    with MOUNT_LOCK:
+        if result_path_mounted():
+            return False
+        return os.system("mkdir -p " + RESULT_PATH + " && mount /dev/disk/by-label/ALGTEST_RES " + RESULT_PATH) == 0
+
+
+def algtest_help(args=()):
+    """Return the --help output of run_algtest or of its command, None if it can not be run."""
+    try:
+        output = subprocess.run([RUN_ALGTEST_SCRIPT] + list(args) + ["--help"], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=ALGTEST_HELP_TIMEOUT).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.decode("ascii", errors="replace")
+
+
+def algtest_commands():
+    """Return the commands run_algtest accepts, None if they can not be determined."""
+    text = algtest_help()
+    # argparse lists the commands as {all,capability,...}
+    match = re.search(r"\{([\w,-]+)\}", text) if text is not None else None
+    return set(match.group(1).split(",")) if match else None
+
+
+def algtest_accepts(command, option):
+    """Return whether run_algtest accepts the option, before or after the command."""
+    pattern = re.compile(r"(?<![\w-])" + re.escape(option) + r"(?![\w-])")
+    return any(text is not None and pattern.search(text) for text in (algtest_help(), algtest_help([command])))
+
+
+def new_out_dir(resumable=True):
+    """Create the output directory of a new run.
+
+    The directory of a resumable run is on the result volume if it is
+    available, so that the run can be resumed after a reboot.
+    """
+    if resumable and result_path_mounted():
+        base_dir = os.path.join(RESULT_PATH, UNFINISHED_RUNS_DIR)
+    else:
+        base_dir = os.path.join(mkdtemp(), "tpm2-algtest")
+    out_dir = os.path.join(base_dir, "algtest_result_" + str(uuid4()))
+    os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+class Checkpoint:
+    """Test categories completed by a run, stored next to its output directory."""
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.path = out_dir + CHECKPOINT_SUFFIX
+        self.extensive = False
+        self.completed = []
+        self.categories = []
+        self.time_budget = None
+        self.time_spent = 0.0
+        self.iterations = None
+        self.adaptive = False
+
+    def load(self):
+        try:
+            with open(self.path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (OSError, ValueError):
             return False
+        self.extensive = checkpoint["extensive"]
+        self.completed = checkpoint["completed"]
+        self.categories = checkpoint["categories"]
+        self.time_budget = checkpoint.get("time_budget")
+        self.time_spent = checkpoint.get("time_spent", 0.0)
+        self.iterations = checkpoint.get("iterations")
+        self.adaptive = checkpoint.get("adaptive", False)
         return True
 
+    def save(self):
+        durable_write(self.path, [json.dumps({
+            "extensive": self.extensive,
+            "completed": self.completed,
+            "categories": self.categories,
+            "time_budget": self.time_budget,
+            "time_spent": self.time_spent,
+            "iterations": self.iterations,
+            "adaptive": self.adaptive,
+        }).encode("utf-8")])
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def find_unfinished_runs():
+    """Return checkpoints of interrupted runs on the result volume, newest first.
+
+    Leftovers of runs which finished (no checkpoint) are removed, their
+    results were already stored.
+    """
+    base_dir = os.path.join(RESULT_PATH, UNFINISHED_RUNS_DIR)
+    if not result_path_mounted() or not os.path.isdir(base_dir):
+        return []
+
+    checkpoints = []
+    for name in os.listdir(base_dir):
+        out_dir = os.path.join(base_dir, name)
+        if not os.path.isdir(out_dir):
+            continue
+        checkpoint = Checkpoint(out_dir)
+        if checkpoint.load():
+            checkpoints.append(checkpoint)
+        else:
+            shutil.rmtree(out_dir, ignore_errors=True)
+            if os.path.exists(out_dir + ".zip"):
+                os.unlink(out_dir + ".zip")
+    return sorted(checkpoints, key=lambda checkpoint: os.path.getmtime(checkpoint.path), reverse=True)
+
+
+class Heartbeat:
+    """Liveness of the runner thread, applied to the UI by the UI thread.
+
+    The runner thread only bumps the counter and the time of the last beat,
+    which is cheap and touches no toolkit objects; the reader decides once
+    per frame what to show and detects stalls.
+    """
+    def __init__(self):
+        self.count = 0
+        self.last_beat = time.monotonic()
+        self.alive = False
+        self.reported_count = None
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+        self.count += 1
+        self.alive = True
+
+    def stop(self):
+        self.alive = False
+
+    def check_stall(self, threshold, now=None):
+        """Return for how long the runner is stalled, only once per stall."""
+        now = time.monotonic() if now is None else now
+        count, last_beat = self.count, self.last_beat
+        if not self.alive or now - last_beat < threshold or count == self.reported_count:
+            return None
+        self.reported_count = count
+        return now - last_beat
+
+
+class RunnerSnapshot:
+    """Consistent view of the runner state for the UI.
+
+    A new snapshot with the next version is published on every change and
+    never modified afterwards, so the UI can read all of its fields without
+    taking info_lock and skip the refresh when the version did not change.
+    """
+    __slots__ = ("version", "state", "status", "percentage", "eta", "text_cursor", "upload_progress",
+                 "io_busy", "finished", "stall", "analyzed")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("runner snapshots are immutable")
+
+
+def network_signature():
+    """State of the network interfaces, changes when a network is (dis)connected."""
+    signature = []
+    try:
+        interfaces = sorted(os.listdir(NETWORK_INTERFACES_PATH))
+    except OSError:
+        return None
+    for interface in interfaces:
+        if interface == "lo":
+            continue
+        try:
+            with open(os.path.join(NETWORK_INTERFACES_PATH, interface, "operstate")) as operstate_file:
+                signature.append((interface, operstate_file.read().strip()))
+        except OSError:
+            continue
+    return tuple(signature)
+
+
+class ConnectivityMonitor(Thread):
+    """Knows whether the depository is reachable, without blocking the caller.
+
+    The depository host is probed in the background by a HEAD request. A
+    positive result is trusted for CONNECTIVITY_TTL seconds, a negative one
+    is retried sooner, and a change of the network interfaces (e.g. Wi-Fi
+    configured by the user) triggers a new probe right away. Readers get
+    the last result and a version which changes with every new result.
+    While paused, e.g. during a test, it neither wakes up nor probes
+    unless refresh() asks for a probe.
+    """
+    def __init__(self, url=DEPOSITORY_URL):
+        super().__init__(daemon=True)
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.path = parts.path or "/"
+        self.lock = Lock()
+        self.online = None
+        self.checked_at = None
+        self.version = 0
+        self.wakeup = Event()
+        self.stop_event = Event()
+        self.paused = Event()
+
+    def run(self):
+        signature = network_signature()
+        next_probe = 0
+        while not self.stop_event.is_set():
+            if self.paused.is_set() and not self.wakeup.is_set():
+                self.wakeup.wait()
+                continue
+            current = network_signature()
+            if current != signature or self.wakeup.is_set() or time.monotonic() >= next_probe:
+                signature = current
+                self.wakeup.clear()
+                online = self.probe()
+                with self.lock:
+                    if online != self.online:
+                        self.version += 1
+                    self.online = online
+                    self.checked_at = time.monotonic()
+                next_probe = time.monotonic() + (CONNECTIVITY_TTL if online else CONNECTIVITY_OFFLINE_RETRY)
+            self.wakeup.wait(CONNECTIVITY_WATCH_INTERVAL)
+
+    def probe(self):
+        import http.client
+
+        connection = http.client.HTTPSConnection(self.host, timeout=CONNECTIVITY_TIMEOUT)
+        try:
+            connection.request("HEAD", self.path, headers={"User-Agent": "tpm2-algtest-ui"})
+            return connection.getresponse().status < 500
+        except (OSError, http.client.HTTPException):
+            return False
+        finally:
+            connection.close()
+
+    def refresh(self):
+        """Probe again as soon as possible."""
+        self.wakeup.set()
+
+    def pause(self):
+        self.paused.set()
+
+    def resume(self):
+        """Resume the periodic probes, starting with one right away."""
+        self.paused.clear()
+        self.wakeup.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def get_state(self):
+        """Return the version and the last result, None if not probed yet."""
+        with self.lock:
+            return self.version, self.online
+
 
 class AlgtestState(Enum):
     NOT_RUNNING = auto()
@@ -223,65 +2122,133 @@ class StoreType(Enum):
     CANCEL = auto()
 
 
+class IOJobState(Enum):
+    NOT_STARTED = auto()
+    RUNNING = auto()
+    SUCCESS = auto()
+    FAILED = auto()
+
+
 class AlgtestTestRunner(Thread):
-    def __init__(self, out_dir, extensive, watchdog_tick=None):
+    def __init__(self, out_dir, extensive, resume=False, iterations=None, adaptive=False,
+                 time_budget=None, tcti=TCTII, record=None, replay=None):
         super().__init__(name="AlgtestTestRunner")
         self.out_dir = out_dir
         self.detail_dir = os.path.join(self.out_dir, 'detail')
         self.cmd = [RUN_ALGTEST_SCRIPT, '--include-legacy', '--machine-readable-statuses', '--use-system-algtest',
-                    '--outdir', self.out_dir, "--with-image-tag", IMAGE_TAG, "--with-tctii", TCTII]
+                    '--outdir', self.out_dir, "--with-image-tag", IMAGE_TAG, "--with-tctii", tcti]
+        self.tcti = tcti
         self.extensive = extensive
+        self.checkpoint = Checkpoint(self.out_dir)
+        self.resume = resume and self.checkpoint.load()
+        if self.resume:
+            self.extensive = self.checkpoint.extensive
+            time_budget = self.checkpoint.time_budget
+            iterations = self.checkpoint.iterations
+            adaptive = self.checkpoint.adaptive
+        self.category_index = 0
+        self.category_count = 1
+        self.current_category = None
+        self.iterations = iterations
+        self.adaptive = adaptive
+        self.used_iterations = {}
+        # per category, whether run_algtest accepts ITERATIONS_OPTION
+        self.iterations_accepted = {}
+        self.recorder = SessionRecorder(record) if record is not None else None
+        self.replay = replay
+        self.category_durations = {}
+        self.time_budget = time_budget
+        self.planner = TimeBudgetPlanner(time_budget) if time_budget else None
+        self.measurements = MeasurementMonitor(self.detail_dir)
 
         self.percentage = 0
-        self.text = []
+        self.log = LogBuffer(LOG_BUFFER_CAPACITY)
+        self.profiler = PhaseProfiler()
+        self.eta = EtaEstimator()
+        self.run_log = RunLog(os.path.join(self.out_dir, RUN_LOG_NAME))
         self.statuses = []
         self.status = ""
         self.state = AlgtestState.NOT_RUNNING
-        self.watchdog_tick = watchdog_tick
+        self.upload_progress = None
+        self.result_sha256 = None
+        self.heartbeat = Heartbeat()
+        self.stall = None
+        self.analysis = None
+        self.rng_check = None
         self.info_lock = Lock()
-        self.info_changed = True
+        self.snapshot = None
+        self.snapshot_time = 0
 
         self.tests_to_run = deque()
         self.algtest_proc = None
         self.shall_stop = False
-        self.internet_connected = None
+        self.wakeup_pipe = None
 
         self.test_finished = False
         self.email = None
 
         self.uploader = ISUploader("tpm2-algtest-ui", DEPOSITORY_UCO)
+        self.outbox = UploadOutbox()
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="AlgtestIO")
+        self.io_jobs = {}
+        with self.info_lock:
+            self.publish_snapshot()
 
-    def run_and_monitor(self, cmd):
+    def run_and_monitor(self, cmd, phase=None):
         with self.info_lock:
-            self.shall_stop = False
+            self.wakeup_pipe = os.pipe()
         self.set_state(AlgtestState.RUNNING)
-        self.algtest_proc = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-
-        fd = self.algtest_proc.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        if self.replay is not None:
+            self.replay.restore_files(self.out_dir)
+            self.algtest_proc = self.replay.popen(cmd)
+        else:
+            self.algtest_proc = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        if self.recorder is not None:
+            self.recorder.start_process(cmd)
+        if phase is not None:
+            self.profiler.start(self.algtest_proc.pid, phase)
 
-        self.monitor_algtest()
+        partial_line = self.monitor_algtest()
+        self.profiler.finish()
 
         if self.algtest_proc.poll() is None:
             if self.get_shall_stop():
                 self.algtest_proc.terminate()
 
-            print("Waiting for the tpm2_algtest process to finish...")
-            self.append_text("Waiting for the tpm2_algtest process to finish...")
+                print("Waiting for the tpm2_algtest process to finish...", file=sys.stderr)
+                self.append_text("Waiting for the tpm2_algtest process to finish...")
             self.algtest_proc.wait()
 
-        # read the rest of output, except the trailing newline
-        text = self.algtest_proc.stdout.read()
-        if text:
-            self.append_text(text.decode("ascii")[:-1])
+        # read the rest of output, including a last line without the trailing newline
+        rest = self.drain_output()
+        if self.recorder is not None:
+            self.recorder.output(rest)
+            self.recorder.exit(self.algtest_proc.returncode)
+        rest = partial_line + rest
+        for line in rest.split(b"\n"):
+            self.process_line(line.decode("ascii", errors="replace"))
+        with self.info_lock:
+            self.publish_snapshot()
+
+        with self.info_lock:
+            for fd in self.wakeup_pipe:
+                os.close(fd)
+            self.wakeup_pipe = None
 
         return self.algtest_proc.returncode
 
     def format_results(self):
+        # formatting the partial results does not make a failed or stopped test successful
+        state = self.get_state()
         self.append_text("Formatting results...")
         self.set_status("Formatting results...")
+        # the stop, if any, was already handled, let the formatting finish
+        with self.info_lock:
+            stopped = self.shall_stop
+            self.shall_stop = False
         code = self.run_and_monitor(self.cmd + ["format"])
+        with self.info_lock:
+            self.shall_stop = self.shall_stop or stopped
         if code != 0:
             if not self.get_shall_stop():
                 self.set_status("Failed to format the results.")
@@ -291,20 +2258,123 @@ class AlgtestTestRunner(Thread):
                 self.set_state(AlgtestState.STOPPED)
             self.tick(False)
         else:
-            self.set_state(AlgtestState.SUCCESS)
+            self.set_state(state if state in (AlgtestState.FAILED, AlgtestState.STOPPED) else AlgtestState.SUCCESS)
             self.set_status("Formatted the results successfully.")
+            self.finalize_archive()
         return code
 
+    def write_timings(self):
+        self.profiler.write(os.path.join(self.out_dir, TIMINGS_NAME))
+        summary = self.profiler.summary()
+        print(summary, file=sys.stderr)
+        self.append_text(summary)
+
+    def finalize_archive(self):
+        """Add the files produced by the UI itself to the result archive and summarize it."""
+        self.run_log.flush()
+        names = (TIMINGS_NAME, PRECISION_NAME, ANALYSIS_NAME, RNG_CHECK_NAME)
+        self.add_to_archive([os.path.join(self.out_dir, name) for name in names] + [self.run_log.path])
+        self.write_summary()
+
+    def write_summary(self):
+        """Write the summary of the run, which is uploaded before the archive.
+
+        It holds the TPM properties, the supported algorithms and commands,
+        the statistics of every measured operation, the verdict of the RNG
+        output check and the checksum of the archive, a few kilobytes instead of the megabytes of the archive.
+        The statistics are the exact ones of write_analysis(), the streaming
+        estimates are only good enough for the progress shown while testing.
+        """
+        result_zip = self.out_dir + '.zip'
+        digest = hashlib.sha256()
+        for chunk in read_chunks(result_zip):
+            digest.update(chunk)
+        analysis = self.get_analysis()
+        if analysis is not None:
+            analysis = {name: dict(stats, category=self.measurements.categories.get(name + ".csv"))
+                        for name, stats in analysis.items()}
+        summary = {
+            "version": VERSION,
+            "state": self.get_state().name,
+            "extensive": self.extensive,
+            "iterations": self.used_iterations,
+            "archive": {"name": os.path.basename(result_zip), "size": os.path.getsize(result_zip),
+                        "sha256": digest.hexdigest()},
+            "properties": read_tpm_properties(self.out_dir),
+            "algorithms": read_capability_names(self.out_dir, "Capability_algorithms.txt"),
+            "commands": read_capability_names(self.out_dir, "Capability_commands.txt"),
+            # None if NumPy is not installed
+            "measurements": analysis,
+            "rng_check": self.get_rng_check(),
+        }
+        with open(self.out_dir + SUMMARY_SUFFIX, "w") as summary_file:
+            json.dump(summary, summary_file, indent=1)
+
+    def add_to_archive(self, paths):
+        """Add files to the result archive, replacing the copies format already included.
+
+        The copy of format may be incomplete, e.g. the run log before its
+        last lines. A zip entry can not be removed, so the archive is then
+        rewritten without the replaced entries, which keep their names.
+        """
+        result_zip = self.out_dir + '.zip'
+        paths = [path for path in paths if os.path.exists(path)]
+        names = {os.path.basename(path) for path in paths}
+        with zipfile.ZipFile(result_zip) as archive:
+            replaced = {os.path.basename(info.filename): info.filename for info in archive.infolist()
+                        if os.path.basename(info.filename) in names}
+        if replaced:
+            rewritten_zip = result_zip + ".tmp"
+            with zipfile.ZipFile(result_zip) as archive, zipfile.ZipFile(rewritten_zip, "w") as rewritten:
+                for info in archive.infolist():
+                    if info.filename in replaced.values():
+                        continue
+                    with archive.open(info) as source, rewritten.open(info, "w") as target:
+                        shutil.copyfileobj(source, target, RUN_LOG_BUFFER_SIZE)
+            os.replace(rewritten_zip, result_zip)
+        with zipfile.ZipFile(result_zip, "a", zipfile.ZIP_DEFLATED) as archive:
+            for path in paths:
+                name = os.path.basename(path)
+                archive.write(path, replaced.get(name, name))
+
     def run(self):
+        try:
+            return self.run_tests()
+        finally:
+            self.run_log.close()
+            if self.recorder is not None:
+                self.recorder.close(self.out_dir)
+
+    def run_tests(self):
         self.set_percentage(1)
         self.append_text("Starting TPM test..")
+        if self.tcti != TCTII:
+            self.append_text("Testing the TPM at " + self.tcti)
         os.makedirs(self.detail_dir, exist_ok=True)
         self.tick()
 
-        code = self.run_and_monitor(self.cmd + ["extensive" if self.extensive else "all"])
+        self.mount_result_path()
+        if os.path.exists(self.out_dir + '.zip'):
+            # partial results of the interrupted run which is being resumed
+            os.unlink(self.out_dir + '.zip')
+
+        code = self.run_categories()
+        self.write_timings()
+        self.write_precision()
+        self.write_analysis()
+        self.write_rng_check()
+        with self.info_lock:
+            self.eta.end_category()
+        if code == 0:
+            self.detect_tpm()
+            try:
+                self.record_iterations_history()
+                self.eta.record_history()
+            except OSError as e:
+                self.append_text("Failed to store the timing history: " + str(e))
         if code != 0:
             if not self.get_shall_stop():
-                print("The run_algtest process failed. Please try to re-run the test.")
+                print("The run_algtest process failed. Please try to re-run the test.", file=sys.stderr)
                 self.set_state(AlgtestState.FAILED)
                 self.tick(False)
                 self.format_results()
@@ -318,144 +2388,571 @@ class AlgtestTestRunner(Thread):
                 self.tick(False)
                 self.format_results()
                 self.tick(False)
-            with self.info_lock:
-                self.test_finished = True
+            self.set_finished()
             return code
 
-        self.append_text("Testing internet connection...")
-        self.set_status("Testing internet connection...")
-        self.test_connection()
+        self.checkpoint.remove()
+        if os.path.exists(self.out_dir + '.zip'):
+            # run_algtest archived the results itself, the summary needs the final state
+            self.set_state(AlgtestState.STOPPED if self.get_shall_stop() else AlgtestState.SUCCESS)
+            self.finalize_archive()
+        else:
+            self.format_results()
+
         self.tick()
 
         self.set_percentage(100)
-        with self.info_lock:
-            self.test_finished = True
 
+        # the state is final before the results are stored
         if self.get_shall_stop():
             self.append_text("Stop requested.")
             self.set_status("Stop requested.")
             self.set_state(AlgtestState.STOPPED)
             self.tick(False)
+            self.set_finished()
             return 1
         else:
             self.set_state(AlgtestState.SUCCESS)
             self.append_text("All tests finished successfully.")
             self.set_status("All tests finished successfully.")
             self.tick(False)
+            self.set_finished()
             return 0
 
-    def test_connection(self):
+    def category_options(self, category):
+        if category not in ITERATED_CATEGORIES:
+            return []
+
+        iterations = self.iterations
+        if self.planner is not None:
+            iterations = self.planner.plan.get(category, iterations)
+        if iterations is None:
+            return []
+        if self.replay is None and category not in self.iterations_accepted:
+            self.iterations_accepted[category] = algtest_accepts(category, ITERATIONS_OPTION)
+        if not self.iterations_accepted.get(category, True):
+            self.append_text("run_algtest does not accept %s, running the default number of repetitions of %s." % (
+                ITERATIONS_OPTION, category))
+            return []
+        if self.adaptive:
+            # as many repetitions as the measurements of earlier runs on this TPM needed
+            self.detect_tpm()
+            required = self.eta.from_history("iterations " + category)
+            if required is not None:
+                mean, variance = required
+                limit = iterations
+                iterations = min(max(int(mean + variance ** 0.5) + 1, ADAPTIVE_MIN_ITERATIONS), limit)
+                self.append_text("Adaptive mode: running %d of at most %d repetitions of %s." % (
+                    iterations, limit, category))
+            else:
+                self.append_text("Adaptive mode: no earlier run on this TPM, running %d repetitions of %s." % (
+                    iterations, category))
+        self.used_iterations[category] = iterations
+        return [ITERATIONS_OPTION, str(iterations)]
+
+    def write_precision(self):
+        streams = self.measurements.summary(ADAPTIVE_TARGET_WIDTH)
+        with open(os.path.join(self.out_dir, PRECISION_NAME), "w") as precision_file:
+            json.dump({
+                "target_relative_width": ADAPTIVE_TARGET_WIDTH,
+                "confidence_z": ADAPTIVE_CONFIDENCE_Z,
+                "adaptive": self.adaptive,
+                "iterations": self.used_iterations,
+                "streams": streams,
+            }, precision_file, indent=1)
+        if streams:
+            converged = sum(1 for stream in streams.values() if stream["converged"])
+            self.append_text("Measurement precision: %d of %d operations measured within ±%.1f %%." % (
+                converged, len(streams), 100 * ADAPTIVE_TARGET_WIDTH / 2))
+
+    def write_analysis(self):
+        start = time.monotonic()
+        try:
+            analysis = analyze_measurements(self.detail_dir)
+        except MemoryError:
+            self.append_text("Not enough memory to analyze the measurements.")
+            return
+        except OSError as e:
+            self.append_text("Failed to analyze the measurements: " + str(e))
+            return
+        if analysis is None:
+            self.append_text("NumPy is not installed, the measurements are not analyzed.")
+            return
+        try:
+            with open(os.path.join(self.out_dir, ANALYSIS_NAME), "w") as analysis_file:
+                json.dump({"outlier_iqr": ANALYSIS_OUTLIER_IQR, "operations": analysis}, analysis_file, indent=1)
+        except OSError as e:
+            self.append_text("Failed to store the analysis of the measurements: " + str(e))
+        self.append_text("Analyzed the measurements of %d operations in %.1f s." % (
+            len(analysis), time.monotonic() - start))
+        with self.info_lock:
+            self.analysis = analysis
+            self.publish_snapshot()
+
+    def get_analysis(self):
+        with self.info_lock:
+            return self.analysis
+
+    def write_rng_check(self):
+        """Check the output of the RNG before the results are stored, so that a broken one is noticed."""
+        path = find_result_file(self.out_dir, RNG_NAME)
+        if path is not None:
+            try:
+                rng_check = check_rng_output(path)
+            except MemoryError:
+                self.append_text("Not enough memory to check the RNG output.")
+                return
+            except OSError as e:
+                self.append_text("Failed to check the RNG output: " + str(e))
+                return
+            if rng_check is None:
+                # already reported by write_analysis()
+                return
+        elif any(category in self.checkpoint.completed for category in RNG_CATEGORIES):
+            rng_check = {"verdict": "FAIL", "failures": [RNG_NAME + " is missing"], "size": 0}
+        else:
+            return
+        try:
+            with open(os.path.join(self.out_dir, RNG_CHECK_NAME), "w") as rng_check_file:
+                json.dump(rng_check, rng_check_file, indent=1)
+        except OSError as e:
+            self.append_text("Failed to store the RNG output check: " + str(e))
+        self.append_text(format_rng_check(rng_check))
+        with self.info_lock:
+            self.rng_check = rng_check
+            self.publish_snapshot()
+
+    def get_rng_check(self):
+        with self.info_lock:
+            return self.rng_check
+
+    def plan_time_budget(self):
+        if self.planner is None:
+            return
+        self.detect_tpm()
+        self.planner.load(self.eta.history, self.eta.tpm_id)
+        categories = list(self.tests_to_run)
+        self.planner.replan(self.checkpoint.time_spent, categories)
+        remaining = max(self.time_budget - self.checkpoint.time_spent, 0)
+        self.append_text("Time budget plan (%s left): %s" % (format_duration(remaining),
+                                                            self.planner.describe(categories)))
+
+    def record_iterations_history(self):
+        if self.eta.history is None or self.eta.tpm_id is None:
+            return
+        for category, duration in self.category_durations.items():
+            iterations = self.used_iterations.get(category)
+            if category in ITERATED_CATEGORIES and iterations:
+                self.eta.history.record(self.eta.tpm_id, "repetition " + category, category, duration / iterations)
+        for category in ITERATED_CATEGORIES:
+            required = self.measurements.required_samples(category, ADAPTIVE_TARGET_WIDTH)
+            if required is not None:
+                self.eta.history.record(self.eta.tpm_id, "iterations " + category, category, required)
+
+    def basic_categories(self):
+        """Return the commands of the basic test, TEST_CATEGORIES if run_algtest has all of them."""
+        if self.replay is not None:
+            return list(TEST_CATEGORIES)
+        commands = algtest_commands()
+        if commands is None or not commands.issuperset(TEST_CATEGORIES):
+            self.append_text("run_algtest can not run the test categories one by one, running them at once.")
+            return ["all"]
+        return list(TEST_CATEGORIES)
+
+    def run_categories(self):
+        """Run the test categories from tests_to_run, checkpointing after each of them."""
+        if self.resume:
+            self.profiler.load(os.path.join(self.out_dir, TIMINGS_NAME))
+            self.append_text("Resuming the test, already completed: " + ", ".join(self.checkpoint.completed))
+        else:
+            self.checkpoint.extensive = self.extensive
+            self.checkpoint.categories = ["extensive"] if self.extensive else self.basic_categories()
+            self.checkpoint.time_budget = self.time_budget
+            self.checkpoint.iterations = self.iterations
+            self.checkpoint.adaptive = self.adaptive
+        if self.planner is not None and self.extensive:
+            self.append_text("The time budget applies to the basic test only, running the extensive test in full.")
+            self.planner = None
+        if self.adaptive and self.extensive:
+            self.append_text("The adaptive number of repetitions applies to the basic test only.")
+
         try:
-            urllib.request.urlopen('http://google.com', timeout=2)  # Python 3.x
+            self.checkpoint.save()
+        except OSError as e:
+            self.append_text("Failed to store the checkpoint, the test can not be resumed: " + str(e))
+
+        self.tests_to_run.extend(category for category in self.checkpoint.categories
+                                 if category not in self.checkpoint.completed)
+        with self.info_lock:
+            self.category_count = len(self.checkpoint.categories)
+            self.category_index = self.category_count - len(self.tests_to_run)
+
+        self.plan_time_budget()
+        code = 0
+        while self.tests_to_run:
+            if self.get_shall_stop():
+                return 1
+
+            category = self.tests_to_run[0]
             with self.info_lock:
-                self.internet_connected = True
-        except:
+                self.eta.begin_category(category, list(self.tests_to_run)[1:])
+            self.current_category = category
+            started = time.monotonic()
+            code = self.run_and_monitor(self.cmd + self.category_options(category) + [category], phase=category)
+            duration = time.monotonic() - started
+            self.measurements.poll(category, force=True)
+            if code != 0:
+                return code
+
+            self.tests_to_run.popleft()
+            self.category_durations[category] = duration
+            self.checkpoint.time_spent += duration
+            if self.planner is not None:
+                # correct the plan of the remaining categories by the actual throughput
+                self.detect_tpm()
+                self.planner.load(self.eta.history, self.eta.tpm_id)
+                self.planner.observe(category, duration, self.used_iterations.get(category))
+                if self.tests_to_run:
+                    self.plan_time_budget()
+            self.checkpoint.completed.append(category)
+            try:
+                self.checkpoint.save()
+            except OSError as e:
+                self.append_text("Failed to store the checkpoint: " + str(e))
             with self.info_lock:
-                self.internet_connected = False
+                self.category_index += 1
+        return code
+
+    def mount_result_path(self):
+        if mount_result_path():
+            self.append_text("Successfully mounted ALGTEST_RES partition")
 
     def store_results(self, store_type):
+        if self.replay is not None:
+            self.append_text("The results of a replayed session are not stored.")
+            return False
+        if store_type == StoreType.STORE_USB:
+            return self.store_usb()
+        if store_type == StoreType.UPLOAD:
+            return self.upload_results()
+        return True
+
+    def store_usb(self):
         result_zip = self.out_dir + '.zip'
         zip_filename = os.path.basename(result_zip)
+        self.mount_result_path()
 
-        if store_type == StoreType.STORE_USB:
-            if not os.path.isdir(RESULT_PATH):
-                if os.system("mkdir -p " + RESULT_PATH + " && mount /dev/disk/by-label/ALGTEST_RES " + RESULT_PATH) == 0:
-                    self.append_text("Successfully mounted ALGTEST_RES partition")
-
-            if os.path.isdir(RESULT_PATH):
-                try:
-                    copyfile(result_zip, os.path.join(RESULT_PATH, zip_filename))
-                    self.append_text("Copied to USB. File name: " + zip_filename)
-                    with open(os.path.join(RESULT_PATH, "README_AND_HOW_TO_UPLOAD.txt"), "w") as readme_file:
-                        readme_file.write(INFO_MESSAGE_PLAIN)
-                    os.sync()
-                except:
-                    self.append_text("Failed to copy to USB.")
-                    self.set_status("Failed to copy to USB.")
+        if not result_path_mounted():
+            self.append_text("ALGTEST_RES partition is not mounted. Can not store on USB.")
+            return False
+
+        try:
+            # before the archive, so that the outbox never sees an archive without its summary
+            summary = self.out_dir + SUMMARY_SUFFIX
+            if os.path.exists(summary):
+                summary_filename = os.path.basename(summary)
+                update_checksums(RESULT_PATH, summary_filename,
+                                 durable_copy(summary, os.path.join(RESULT_PATH, summary_filename)))
+
+            destination = os.path.join(RESULT_PATH, zip_filename)
+            for attempt in range(USB_WRITE_ATTEMPTS):
+                digest = durable_copy(result_zip, destination)
+                if self.verify_on_usb(destination, digest):
+                    break
+                self.append_text("The archive on the USB is corrupted, writing it again...")
             else:
-                self.append_text("ALGTEST_RES partition is not mounted. Can not store on USB.")
+                raise OSError("the archive could not be verified on the USB")
+            with self.info_lock:
+                self.result_sha256 = digest
+
+            self.append_text("Copied to USB. File name: " + zip_filename)
+            update_checksums(RESULT_PATH, zip_filename, digest)
+            durable_write(os.path.join(RESULT_PATH, "README_AND_HOW_TO_UPLOAD.txt"), [INFO_MESSAGE_PLAIN.encode("utf-8")])
+        except (OSError, subprocess.CalledProcessError):
+            self.append_text("Failed to copy to USB.")
+            self.set_status("Failed to copy to USB.")
+            return False
+        return True
 
-        if store_type == StoreType.UPLOAD:
-            self.append_text("Uploading results...")
-            if self.uploader.upload(result_zip):
-                self.append_text("Results uploaded successfully.")
-                self.set_status("Results uploaded successfully.")
+    def verify_on_usb(self, path, digest):
+        start = time.monotonic()
+        stored_digest = file_sha256(path)
+        duration = max(time.monotonic() - start, 1e-6)
+        size = os.path.getsize(path) / 2**20
+        self.append_text("Verified %s on the USB: %s (%.1f MB, %.1f MB/s)" % (
+            os.path.basename(path), "OK" if stored_digest == digest else "CHECKSUM MISMATCH", size, size / duration))
+        return stored_digest == digest
+
+    def upload_results(self):
+        """Upload the summary of the results in one small request, then the archive.
+
+        If the archive cannot be uploaded, at least the summary arrives,
+        and the archive stays in the outbox to be uploaded later. The
+        archive is uploaded also if the summary could not be.
+        """
+        summary = self.out_dir + SUMMARY_SUFFIX
+        if os.path.exists(summary):
+            self.append_text("Uploading the summary of the results...")
+            uploaded, error = self.upload_file(summary)
+            if uploaded:
+                self.append_text("Summary uploaded.")
             else:
-                self.append_text("Results upload failed.")
-                self.set_status("Results upload failed.")
+                self.append_text("Failed to upload the summary: %s" % (error or "unknown error"))
+
+        self.append_text("Uploading results...")
+        uploaded, error = self.upload_file(self.out_dir + '.zip', progress=self.set_upload_progress)
+        with self.info_lock:
+            self.upload_progress = None
+            self.publish_snapshot()
+        if not uploaded:
+            return self.upload_failed(error)
+        self.append_text("Results uploaded successfully.")
+        self.set_status("Results uploaded successfully.")
+        return True
+
+    def upload_file(self, path, progress=None):
+        """Upload the file, return whether it was uploaded and the error if not."""
+        name = os.path.basename(path)
+        if not self.outbox.available():
+            uploaded = self.uploader.upload(path, progress=progress)
+            return uploaded, self.uploader.last_error
+        # recorded in the outbox, so that the file is not uploaded again when it is drained
+        state = self.outbox.upload(name, self.uploader, path=path, progress=progress, requested=True)
+        return state == "uploaded", self.outbox.load().get(name, {}).get("error")
+
+    def upload_failed(self, error):
+        if error:
+            self.append_text(error)
+        if self.outbox.available():
+            self.append_text("Results upload failed, they stay in the outbox and will be uploaded later.")
+        else:
+            self.append_text("Results upload failed.")
+        self.set_status("Results upload failed.")
+        return False
+
+    def submit_store(self, store_type):
+        """Store or upload the results in the background, unless it is already in progress."""
+        with self.info_lock:
+            job = self.io_jobs.get(store_type)
+            if job is not None and not job.done():
+                return job
+            job = self.io_executor.submit(self.store_results, store_type)
+            self.io_jobs[store_type] = job
+            self.publish_snapshot()
+        job.add_done_callback(lambda _: self.set_info_changed())
+        return job
+
+    def get_job_state(self, store_type):
+        with self.info_lock:
+            job = self.io_jobs.get(store_type)
+        if job is None:
+            return IOJobState.NOT_STARTED
+        if not job.done():
+            return IOJobState.RUNNING
+        if job.exception() is None and job.result():
+            return IOJobState.SUCCESS
+        return IOJobState.FAILED
+
+    def io_busy(self):
+        with self.info_lock:
+            return any(not job.done() for job in self.io_jobs.values())
+
+    def wait_io(self):
+        self.io_executor.shutdown(wait=True)
+
+    def close_io(self):
+        """Let the IO thread exit once the submitted jobs are done, no more jobs can be submitted."""
+        self.io_executor.shutdown(wait=False)
+
+    def set_info_changed(self):
+        with self.info_lock:
+            self.publish_snapshot()
+
+    def publish_snapshot(self):
+        """Publish the current state as a new snapshot, info_lock must be held."""
+        self.snapshot_time = time.monotonic()
+        self.snapshot = RunnerSnapshot(
+            version=self.snapshot.version + 1 if self.snapshot is not None else 0,
+            state=self.state,
+            status=self.status,
+            percentage=self.percentage,
+            eta=self.eta.estimate(self.snapshot_time) if self.state == AlgtestState.RUNNING else None,
+            text_cursor=self.log.next_seq,
+            upload_progress=self.upload_progress,
+            io_busy=any(not job.done() for job in self.io_jobs.values()),
+            finished=self.test_finished,
+            stall=self.stall,
+            analyzed=self.analysis is not None or self.rng_check is not None,
+        )
+
+    def get_snapshot(self):
+        # replacing the reference is atomic, no lock is needed to read it
+        return self.snapshot
+
+    def set_upload_progress(self, sent, total):
+        with self.info_lock:
+            self.upload_progress = (sent, total)
+            self.publish_snapshot()
+
+    def get_upload_progress(self):
+        with self.info_lock:
+            return self.upload_progress
 
     def is_finished(self):
         with self.info_lock:
             return self.test_finished
 
     def set_finished(self):
+        self.heartbeat.stop()
         with self.info_lock:
             self.test_finished = True
-
-    def get_info_changed(self):
-        with self.info_lock:
-            if not self.info_changed:
-                return False
-
-            self.info_changed = False
-            return True
+            self.publish_snapshot()
 
     def monitor_algtest(self):
+        """Block until the process produces output, exits or stop is requested.
+
+        Returns the trailing incomplete line (if any) so that the caller can
+        process it together with the rest of the output.
+        """
         if self.algtest_proc is None:
-            return
+            return b""
 
-        status_regex = re.compile(r'(\+\+\+)(.*)(\+\+\+)')
+        stdout_fd = self.algtest_proc.stdout.fileno()
+        wakeup_fd = self.wakeup_pipe[0]
+        partial_line = b""
 
-        while self.algtest_proc.poll() is None and not self.get_shall_stop():
-            self.tick()
+        with selectors.DefaultSelector() as selector:
+            selector.register(stdout_fd, selectors.EVENT_READ)
+            selector.register(wakeup_fd, selectors.EVENT_READ)
 
-            line = self.algtest_proc.stdout.readline().decode("ascii")
-            while line != "" and not self.get_shall_stop():
-                self.tick()
+            while not self.get_shall_stop():
+                events = selector.select(MONITOR_EXIT_CHECK_INTERVAL)
+                if not events:
+                    if self.algtest_proc.poll() is not None:
+                        break
+                    continue
 
-                match = status_regex.search(line)
-                if 2 < len(line) <= 5 and line[-2] == "%":
-                    self.set_current_test_percentage(int(line[:-2]) / 100)
-                elif match:
-                    self.set_status(match.group(2))
-                    self.append_text(match.group(2))
-                else:
-                    self.append_text(line[:-1])
-                line = self.algtest_proc.stdout.readline().decode("ascii")
+                if any(key.fd == wakeup_fd for key, _ in events):
+                    os.read(wakeup_fd, MONITOR_READ_SIZE)
+                    continue
+
+                chunk = os.read(stdout_fd, MONITOR_READ_SIZE)
+                if not chunk:
+                    # EOF, the process closed its output
+                    break
+                if self.recorder is not None:
+                    self.recorder.output(chunk)
+
+                self.tick()
+                lines = (partial_line + chunk).split(b"\n")
+                partial_line = lines.pop()
+                for line in lines:
+                    self.process_line(line.decode("ascii", errors="replace"))
+                with self.info_lock:
+                    self.publish_snapshot()
+
+        return partial_line
+
+    def drain_output(self):
+        """Read the output left in the pipe after the process exited.
+
+        A grandchild of run_algtest may keep the pipe open, so the reading
+        stops after MONITOR_DRAIN_TIMEOUT even if there is no end of file.
+        """
+        stdout_fd = self.algtest_proc.stdout.fileno()
+        deadline = time.monotonic() + MONITOR_DRAIN_TIMEOUT
+        chunks = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([stdout_fd], [], [], remaining)[0]:
+                print("The output of the tpm2_algtest process is still open, not waiting for its end.",
+                      file=sys.stderr)
+                break
+            chunk = os.read(stdout_fd, MONITOR_READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def process_line(self, line):
+        match = STATUS_REGEX.search(line)
+        if 1 < len(line) <= 4 and line[-1] == "%":
+            self.set_current_test_percentage(int(line[:-1]) / 100)
+            self.measurements.poll(self.current_category)
+        elif match:
+            self.profiler.begin(match.group(2))
+            with self.info_lock:
+                self.eta.begin(match.group(2))
+            self.detect_tpm()
+            self.set_status(match.group(2))
+            self.append_text(match.group(2))
+        else:
+            self.profiler.count_line()
+            # published once for the whole chunk of output by the caller
+            self.append_text(line, publish=False)
 
     def set_current_test_percentage(self, current_test_percentage):
-        regexp = re.compile(r'\([0-9]+/[0-9]+\)')
-        match = regexp.search(self.get_status())
-        if match:
-            current_test, total_tests = match.group(0)[1:-1].split('/')
-            current_test = int(current_test)
-            total_tests = int(total_tests)
-            absolute_percentage = ((current_test - 1) / total_tests) + (1/total_tests) * current_test_percentage
+        # called for every percentage line, so the lock is taken only once
+        with self.info_lock:
+            match = TEST_COUNTER_REGEX.search(self.status)
+            if not match:
+                return
+            current_test = int(match.group(1))
+            total_tests = int(match.group(2))
+            category_percentage = ((current_test - 1) / total_tests) + (1/total_tests) * current_test_percentage
+            self.eta.progress(current_test_percentage)
+            absolute_percentage = (self.category_index + category_percentage) / self.category_count
             absolute_percentage = int(absolute_percentage * 100)
 
             # at this point test is started, so we make the progress at least 1 percent
             absolute_percentage = min(absolute_percentage + 1, 100)
-            self.set_percentage(absolute_percentage)
+            if absolute_percentage != self.percentage or \
+                    time.monotonic() - self.snapshot_time >= SNAPSHOT_ETA_INTERVAL:
+                # the estimate changes even when the percentage does not
+                self.percentage = absolute_percentage
+                self.publish_snapshot()
+
+    def detect_tpm(self):
+        """Identify the TPM once run_algtest gathered its properties and load its timing history."""
+        if self.eta.tpm_id is not None:
+            return
+        properties = read_tpm_properties(self.out_dir)
+        if "TPM2_PT_MANUFACTURER" not in properties:
+            return
+
+        tpm_id = " ".join(properties.get(name, "") for name in
+                          ("TPM2_PT_MANUFACTURER", "TPM2_PT_FIRMWARE_VERSION_1", "TPM2_PT_FIRMWARE_VERSION_2"))
+        history = TimingHistory(timing_history_path())
+        with self.info_lock:
+            self.eta.history = history
+            self.eta.tpm_id = tpm_id
+
+    def get_eta(self):
+        with self.info_lock:
+            return self.eta.estimate()
+
+    def append_text(self, text, publish=True):
+        lines = [line for line in text.splitlines() if line != ""]
+        if not lines:
+            return
 
-    def append_text(self, text):
-        for line in text.splitlines():
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        self.log.append([timestamp + " " + line for line in lines])
+        self.run_log.write(lines)
+        if publish:
             with self.info_lock:
-                if line != "":
-                    self.text.append(datetime.datetime.now().strftime("%H:%M:%S") + " " + line)
-                    self.info_changed = True
+                self.publish_snapshot()
 
     def get_text(self, lines=400):
-        with self.info_lock:
-            return "\n".join(self.text[-lines:] if lines else self.text)
+        return "\n".join(self.log.tail(lines))
+
+    def get_text_since(self, cursor):
+        return self.log.since(cursor)
 
     def set_state(self, state):
         with self.info_lock:
             self.state = state
-            self.info_changed = True
-
-    def get_internet_connected(self):
-        with self.info_lock:
-            return self.internet_connected
+            self.publish_snapshot()
 
     def get_state(self):
         with self.info_lock:
@@ -465,7 +2962,8 @@ class AlgtestTestRunner(Thread):
         with self.info_lock:
             self.status = status
             self.statuses.append("<b>" + datetime.datetime.now().strftime("%H:%M:%S") + "</b>: " + status)
-            self.info_changed = True
+            self.publish_snapshot()
+        self.run_log.write_status(status)
 
     def get_statuses(self):
         with self.info_lock:
@@ -476,13 +2974,29 @@ class AlgtestTestRunner(Thread):
             return self.status
 
     def tick(self, alive=True):
-        if self.watchdog_tick is not None:
-            self.watchdog_tick(alive)
+        if alive:
+            self.heartbeat.beat()
+        else:
+            self.heartbeat.stop()
+        if self.stall is not None:
+            with self.info_lock:
+                self.stall = None
+                self.publish_snapshot()
+            self.append_text("The test continues.")
+
+    def report_stall(self, duration):
+        """Called by the UI thread when there was no heartbeat for too long."""
+        message = "No output from run_algtest for %s, last phase: %s" % (format_duration(duration), self.get_status())
+        with self.info_lock:
+            self.stall = message
+            self.publish_snapshot()
+        self.append_text("Warning: " + message)
 
     def set_percentage(self, value):
         with self.info_lock:
-            self.percentage = value
-            self.info_changed = True
+            if value != self.percentage:
+                self.percentage = value
+                self.publish_snapshot()
 
     def get_percentage(self):
         with self.info_lock:
@@ -491,59 +3005,159 @@ class AlgtestTestRunner(Thread):
     def stop(self):
         with self.info_lock:
             self.shall_stop = True
+            if self.wakeup_pipe is not None:
+                os.write(self.wakeup_pipe[1], b"\0")
 
     def get_shall_stop(self):
         with self.info_lock:
             return self.shall_stop
 
-    def terminate(self):
-        self.stop()
-        if self.is_alive():
-            self.join()
 
-        if self.algtest_proc is not None and self.algtest_proc.poll() is None:
-            self.algtest_proc.terminate()
+class RefreshScheduler:
+    """Decides how long the UI loop waits for events and when it redraws.
+
+    While a test runs or results are being stored, the UI is redrawn at
+    most REFRESH_FRAME_RATE times a second and bursts of runner updates are
+    coalesced into one frame; otherwise the loop wakes up only every
+    REFRESH_IDLE_TIMEOUT milliseconds. Widget setters are called only when
+    the value changes.
+    """
+    def __init__(self):
+        self.widget_values = {}
+        self.last_frame = 0
+        self.last_version = None
+        self.frame_start = None
+        self.frame_times = StreamingStats()
+        self.max_frame_time = 0
+        self.coalesced = 0
+        self.wakeups = 0
+        self.idle_wakeups = 0
+
+    def wait_timeout(self, active):
+        self.wakeups += 1
+        if not active:
+            self.idle_wakeups += 1
+            return REFRESH_IDLE_TIMEOUT
+        remaining = self.last_frame + 1 / REFRESH_FRAME_RATE - time.monotonic()
+        if remaining <= 0:
+            # no frame pending, check for updates once per frame
+            remaining = 1 / REFRESH_FRAME_RATE
+        return max(int(remaining * 1000), REFRESH_MIN_TIMEOUT)
+
+    def frame_due(self):
+        return time.monotonic() - self.last_frame >= 1 / REFRESH_FRAME_RATE
+
+    def begin_frame(self, version):
+        if self.last_version is not None and version > self.last_version:
+            self.coalesced += version - self.last_version - 1
+        self.last_version = version
+        self.frame_start = time.monotonic()
+
+    def end_frame(self):
+        self.last_frame = time.monotonic()
+        self.frame_times.add(self.last_frame - self.frame_start)
+        self.max_frame_time = max(self.max_frame_time, self.last_frame - self.frame_start)
+
+    def set(self, widget, setter, value):
+        key = (id(widget), setter)
+        if key in self.widget_values and self.widget_values[key] == value:
+            return
+        self.widget_values[key] = value
+        getattr(widget, setter)(value)
+
+    def forget_widgets(self):
+        """Must be called when the widgets are destroyed, their ids may be reused."""
+        self.widget_values = {}
+
+    def summary(self):
+        if not self.frame_times.count:
+            return "UI refresh: no frames drawn, %d wakeups (%d idle)." % (self.wakeups, self.idle_wakeups)
+        return "UI refresh: %d frames, frame time mean %.2f ms, p95 %.2f ms, max %.2f ms, " \
+               "%d updates coalesced, %d wakeups (%d idle)." % (
+                   self.frame_times.count, 1000 * self.frame_times.mean,
+                   1000 * self.frame_times.quantiles[0.95].value(), 1000 * self.max_frame_time,
+                   self.coalesced, self.wakeups, self.idle_wakeups)
 
 
 class TPM2AlgtestUI:
-    def __init__(self):
+    def __init__(self, args=None):
         self.reset_ui_members()
 
+        # command line arguments, used to record or replay sessions
+        self.args = args
         self.simple_mode = True
         self.result_stored = False
 
-        #  TODO: init to None
-        self.out_dir = os.path.join(mkdtemp(), "tpm2-algtest", "algtest_result_" + str(uuid4()))
-        os.makedirs(self.out_dir, exist_ok=True)
+        self.out_dir = None
         self.algtest_runner = None
 
+        self.connectivity = ConnectivityMonitor()
+        self.connectivity.start()
+        self.uploader = ISUploader("tpm2-algtest-ui", DEPOSITORY_UCO)
+        self.outbox = UploadOutbox()
+        self.outbox_version = None
+        self.outbox_drained_at = None
+
+        mount_result_path()
+        unfinished_runs = find_unfinished_runs() if not self.replaying() else []
+        self.unfinished_run = unfinished_runs[0] if unfinished_runs else None
+
     def reset_ui_members(self):
         self.dialog = None
         self.vbox = None
         self.group = None
         self.type_box = None
         self.progress_bar = None
+        self.eta_label = None
         self.busy_indicator = None
         self.text = None
+        # the log view of a new dialog is empty, the whole log is loaded into it
+        self.text_cursor = None
+        self.snapshot_version = None
+        if hasattr(self, "refresh_scheduler"):
+            self.refresh_scheduler.forget_widgets()
+        else:
+            self.refresh_scheduler = RefreshScheduler()
         self.bottom_buttons = None
         self.start_short_button = None
         self.start_extensive_button = None
         self.stop_button = None
         self.store_button = None
         self.info_button = None
+        self.analysis_button = None
         self.advanced_button = None
         self.shutdown_checkbox = None
+        self.adaptive_checkbox = None
+        self.duration_buttons = []
+        self.budget_button = None
+        self.budget_field = None
         # self.email_field = None
         self.exit_button = None
 
         self.popup_info = None
         self.popup_info_hide_button = None
+        self.popup_analysis = None
+        self.popup_analysis_close_button = None
+        self.shutdown_pending = False
+        self.exit_pending = False
+        self.applied_beat = None
 
         self.popup = None
         self.popup_buttons = None
         self.popup_upload = None
         self.popup_configure = None
         self.popup_cancel = None
+        self.popup_label = None
+        self.connectivity_shown = None
+
+        self.popup_resume = None
+        self.popup_resume_button = None
+        self.popup_discard_button = None
+
+        self.popup_budget = None
+        self.popup_budget_start_button = None
+        self.popup_budget_cancel_button = None
+        self.budget_extensive = False
 
     def construct_advanced_ui(self):
         self.simple_mode = False
@@ -587,6 +3201,16 @@ class TPM2AlgtestUI:
         self.duration_1500_button = YUI.widgetFactory().createRadioButton(self.duration_box, "&1500")
         self.group.addRadioButton(self.duration_1500_button)
 
+        # the default leaves the number of repetitions to run_algtest
+        self.duration_buttons = [(self.duration_100_button, None), (self.duration_200_button, 200),
+                                 (self.duration_300_button, 300), (self.duration_400_button, 400),
+                                 (self.duration_500_button, 500), (self.duration_1000_button, 1000),
+                                 (self.duration_1500_button, 1500)]
+
+        self.budget_button = YUI.widgetFactory().createRadioButton(self.duration_box, "&Finish within")
+        self.group.addRadioButton(self.budget_button)
+        self.budget_field = YUI.widgetFactory().createIntField(self.duration_box, "minutes", 10, 24 * 60, 120)
+
         # YUI.widgetFactory().createLabel(self.vbox,
         #   "The collected information does not contain any of your personal information.\n" \
         #   "It will be sent to Masaryk University information system and it will be used\n" \
@@ -597,6 +3221,8 @@ class TPM2AlgtestUI:
 
         # self.email_field = YUI.widgetFactory().createInputField(self.vbox, "Your email (optional): ")
 
+        self.adaptive_checkbox = YUI.widgetFactory().createCheckBox(self.vbox, "Adaptive number of repetitions (use as many as earlier runs on this TPM needed for precise results)")
+
         self.running_label = YUI.widgetFactory().createLabel(self.vbox, "Test is not running.")
 
         self.busy_indicator = YUI.widgetFactory().createBusyIndicator(self.vbox, "Test status", 25000)
@@ -605,9 +3231,10 @@ class TPM2AlgtestUI:
         self.progress_bar = YUI.widgetFactory().createProgressBar(self.vbox, "Test progress", 100)
         self.progress_bar.setValue(0)
 
-        self.text = YUI.widgetFactory().createRichText(self.vbox, "", True)
-        self.text.setText("Select the test type and press RUN to start.")
-        self.text.setAutoScrollDown(True)
+        self.eta_label = YUI.widgetFactory().createLabel(self.vbox, "Estimated remaining time: unknown")
+
+        self.text = YUI.widgetFactory().createLogView(self.vbox, "", LOG_VIEW_VISIBLE_LINES, LOG_VIEW_STORED_LINES)
+        self.text.setLogText("Select the test type and press RUN to start.")
 
         self.bottom_buttons = YUI.widgetFactory().createHBox(self.vbox)
         start_highlight_box = YUI.widgetFactory().createHBox(self.bottom_buttons)
@@ -616,6 +3243,8 @@ class TPM2AlgtestUI:
         #self.dialog.highlight(start_highlight_box)
         self.dialog.setDefaultButton(self.start_short_button)
         self.info_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Info")
+        self.analysis_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Measurements")
+        self.analysis_button.setEnabled(self.algtest_runner is not None and self.algtest_runner.get_snapshot().analyzed)
         self.stop_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Stop")
 
         if YUI.application().isTextMode():
@@ -649,10 +3278,12 @@ class TPM2AlgtestUI:
         self.progress_bar = YUI.widgetFactory().createProgressBar(self.vbox, "Test progress", 100)
         self.progress_bar.setValue(0)
 
+        self.eta_label = YUI.widgetFactory().createLabel(self.vbox, "Estimated remaining time: unknown")
+
         self.shutdown_checkbox = YUI.widgetFactory().createCheckBox(self.vbox, "Shutdown automatically when test finishes successfully (results will be stored on the USB, YOU WILL NEED TO UPLOAD THEM LATER MANUALLY)")
+        self.adaptive_checkbox = YUI.widgetFactory().createCheckBox(self.vbox, "Adaptive number of repetitions of the basic test (use as many as earlier runs on this TPM needed for precise results)")
 
-        self.text = YUI.widgetFactory().createRichText(self.vbox, "", True)
-        self.text.setAutoScrollDown(True)
+        self.text = YUI.widgetFactory().createLogView(self.vbox, "", LOG_VIEW_VISIBLE_LINES, LOG_VIEW_STORED_LINES)
 
         self.bottom_buttons = YUI.widgetFactory().createHBox(self.vbox)
         start_highlight_box = YUI.widgetFactory().createHBox(self.bottom_buttons)
@@ -667,36 +3298,124 @@ class TPM2AlgtestUI:
         if  YUI.application().isTextMode():
             self.exit_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Exit")
         self.shutdown_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Shutdown PC")
+        # the test types and the time budget
+        self.advanced_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Advanced mode")
 
         self.dialog.open()
         self.dialog.activate()
 
     def popup_ask_upload(self):
-        if self.algtest_runner.get_internet_connected():
-            popup_text = POPUP_TEXT + "\n" + POPUP_TEXT_ONLINE
-        else:
-            popup_text = POPUP_TEXT + "\n" + POPUP_TEXT_OFFLINE
-
         self.popup = YUI.widgetFactory().createPopupDialog()
         popup_vbox = YUI.widgetFactory().createVBox(self.popup)
-        YUI.widgetFactory().createLabel(popup_vbox, popup_text)
+        self.popup_label = YUI.widgetFactory().createLabel(popup_vbox, POPUP_TEXT + "\n" + POPUP_TEXT_CHECKING)
         self.popup_buttons = YUI.widgetFactory().createHBox(popup_vbox)
 
         self.popup_buttons = YUI.widgetFactory().createHBox(popup_vbox)
-        if not self.algtest_runner.get_internet_connected():
-            self.popup_configure = YUI.widgetFactory().createPushButton(self.popup_buttons, "&Configure network")
+        self.popup_configure = YUI.widgetFactory().createPushButton(self.popup_buttons, "&Configure network")
         self.popup_upload = YUI.widgetFactory().createPushButton(self.popup_buttons, "&Upload results")
 
         self.popup_cancel = YUI.widgetFactory().createPushButton(self.popup_buttons, "&Cancel")
 
+        self.connectivity_shown = None
+        self.show_connectivity()
         self.popup.open()
         self.popup.activate()
 
-    def popup_info_show(self):
-        if YUI.application().isTextMode():
-            self.text.setText(INFO_MESSAGE_PLAIN)
+    def show_connectivity(self):
+        """Update the upload popup and button when the connectivity changes."""
+        state = self.connectivity.get_state()
+        if state == self.connectivity_shown:
             return
+        self.connectivity_shown = state
+        _, online = state
+
+        if self.popup is not None and self.popup_label is not None:
+            if online is None:
+                self.popup_label.setText(POPUP_TEXT + "\n" + POPUP_TEXT_CHECKING)
+            elif online:
+                self.popup_label.setText(POPUP_TEXT + "\n" + POPUP_TEXT_ONLINE)
+            else:
+                self.popup_label.setText(POPUP_TEXT + "\n" + POPUP_TEXT_OFFLINE)
+            self.popup_configure.setEnabled(not online)
+        if self.store_button is not None:
+            self.store_button.setLabel("&Upload results" if online is not False else "&Upload results (offline)")
+
+    def drain_outbox(self):
+        """Upload the archives left on the USB in the background when the depository becomes reachable.
+
+        While it stays reachable, the outbox is drained again every
+        OUTBOX_BACKOFF seconds for the files whose backoff has passed. Like
+        the connectivity probes, it waits while a test is running.
+        """
+        if self.algtest_runner is not None and self.algtest_runner.is_alive():
+            return
+        version, online = self.connectivity.get_state()
+        now = time.monotonic()
+        if not online or (version == self.outbox_version and now - self.outbox_drained_at < OUTBOX_BACKOFF):
+            return
+        self.outbox_version = version
+        self.outbox_drained_at = now
 
+        def drain():
+            results = self.outbox.drain(self.uploader)
+            for name, state in (results or {}).items():
+                print("Outbox: %s %s" % (name, state), file=sys.stderr)
+        Thread(target=drain, name="AlgtestOutbox", daemon=True).start()
+
+    def popup_ask_resume(self):
+        if self.unfinished_run is None:
+            return
+
+        checkpoint = self.unfinished_run
+        completed = len(checkpoint.completed)
+        self.popup_resume = YUI.widgetFactory().createPopupDialog()
+        popup_vbox = YUI.widgetFactory().createVBox(self.popup_resume)
+        YUI.widgetFactory().createLabel(popup_vbox,
+            "An interrupted %s test was found on the USB (%d of %d parts done).\n"
+            "Do you want to resume it? The completed parts will not be run again." % (
+                "extensive" if checkpoint.extensive else "basic", completed, len(checkpoint.categories)))
+        popup_buttons = YUI.widgetFactory().createHBox(popup_vbox)
+        self.popup_resume_button = YUI.widgetFactory().createPushButton(popup_buttons, "&Resume test")
+        self.popup_discard_button = YUI.widgetFactory().createPushButton(popup_buttons, "&Discard")
+
+        self.popup_resume.open()
+        self.popup_resume.activate()
+
+    def close_popup_resume(self):
+        self.popup_resume.destroy()
+        self.popup_resume = None
+        self.unfinished_run = None
+
+    def popup_ask_budget(self, extensive):
+        """Show how the selected time budget is going to be split before the test starts."""
+        budget = self.selected_time_budget()
+        if extensive:
+            message = "The time budget applies to the basic test only, the extensive test runs in full."
+        else:
+            planner = TimeBudgetPlanner(budget)
+            planner.replan(0.0, list(TEST_CATEGORIES))
+            message = "Planned for %s: %s.\nThe repetitions are revised once the TPM is identified\n" \
+                      "and after every part of the test, from its actual speed." % (
+                          format_duration(budget), planner.describe(TEST_CATEGORIES))
+        self.budget_extensive = extensive
+        self.popup_budget = YUI.widgetFactory().createPopupDialog()
+        popup_vbox = YUI.widgetFactory().createVBox(self.popup_budget)
+        YUI.widgetFactory().createLabel(popup_vbox, message)
+        popup_buttons = YUI.widgetFactory().createHBox(popup_vbox)
+        self.popup_budget_start_button = YUI.widgetFactory().createPushButton(popup_buttons, "&Start test")
+        self.popup_budget_cancel_button = YUI.widgetFactory().createPushButton(popup_buttons, "&Cancel")
+
+        self.popup_budget.open()
+        self.popup_budget.activate()
+
+    def close_popup_budget(self):
+        self.popup_budget.destroy()
+        self.popup_budget = None
+        self.popup_budget_start_button = None
+        self.popup_budget_cancel_button = None
+
+    def popup_info_show(self):
+        # a popup in text mode too, the log under it is redrawn on every update
         self.popup_info = YUI.widgetFactory().createPopupDialog()
         self.popup_info.setSize(70, 70)
         if not YUI.application().isTextMode():
@@ -708,7 +3427,10 @@ class TPM2AlgtestUI:
         # YUI.widgetFactory().createLabel(popup_vbox, INFO_MESSAGE)
 
         text_vbox = YUI.widgetFactory().createVBox(popup_vbox)
-        text = YUI.widgetFactory().createRichText(text_vbox, INFO_MESSAGE)
+        if YUI.application().isTextMode():
+            text = YUI.widgetFactory().createRichText(text_vbox, INFO_MESSAGE_PLAIN, True)
+        else:
+            text = YUI.widgetFactory().createRichText(text_vbox, INFO_MESSAGE)
         text.setShrinkable(False)
 
         self.popup_info_hide_button = YUI.widgetFactory().createPushButton(popup_vbox, "&Continue")
@@ -717,20 +3439,193 @@ class TPM2AlgtestUI:
         self.popup_info.activate()
 
 
+    def popup_analysis_show(self):
+        """Show the statistics of the measurements and the RNG output check computed after the test."""
+        analysis = self.algtest_runner.get_analysis()
+        rng_check = self.algtest_runner.get_rng_check()
+        table = "\n\n".join(([format_analysis(analysis)] if analysis is not None else []) +
+                             ([format_rng_check(rng_check)] if rng_check is not None else []))
+        self.popup_analysis = YUI.widgetFactory().createPopupDialog()
+        if YUI.application().isTextMode():
+            self.popup_analysis.setSize(100, 40)
+            popup_vbox = YUI.widgetFactory().createVBox(self.popup_analysis)
+            text = YUI.widgetFactory().createRichText(popup_vbox, table, True)
+        else:
+            self.popup_analysis.setSize(900, 600)
+            popup_vbox = YUI.widgetFactory().createVBox(self.popup_analysis)
+            text = YUI.widgetFactory().createRichText(popup_vbox, "<pre>" + html.escape(table) + "</pre>")
+        text.setShrinkable(False)
+        self.popup_analysis_close_button = YUI.widgetFactory().createPushButton(popup_vbox, "&Close")
+        self.popup_analysis.open()
+        self.popup_analysis.activate()
+
+    def close_popup_analysis(self):
+        self.popup_analysis.destroy()
+        self.popup_analysis = None
+        self.popup_analysis_close_button = None
+
+    def replaying(self):
+        """Whether the test replays a recorded session, its results are neither stored nor uploaded."""
+        return self.args is not None and self.args.replay is not None
+
+    def result_saved(self):
+        return self.result_stored and self.algtest_runner.get_job_state(StoreType.STORE_USB) in [IOJobState.SUCCESS, IOJobState.FAILED]
+
+    def eta_text(self, snapshot):
+        if snapshot.state != AlgtestState.RUNNING:
+            return ""
+        eta = snapshot.eta
+        if eta is None:
+            return "Estimated remaining time: unknown"
+        remaining, band = eta
+        return "Estimated remaining time: %s (± %s)" % (format_duration(remaining), format_duration(band))
+
+    def selected_iterations(self):
+        """Number of repetitions selected in the advanced UI, None if not selected or the default."""
+        for button, iterations in self.duration_buttons:
+            if button.value():
+                return iterations
+        return None
+
+    def selected_time_budget(self):
+        """Time budget in seconds selected in the advanced UI, None if not selected."""
+        if self.budget_button is None or not self.budget_button.value():
+            return None
+        return self.budget_field.value() * 60
+
+    def start_test(self, extensive, checkpoint=None):
+        if self.store_button is not None:
+            self.store_button.parent().removeChild(self.store_button)
+            self.store_button = None
+            self.result_stored = False
+
+        if not extensive:
+            duration = SHORT_TEST_ITERATIONS
+            rng_iterations = 16384
+        else:
+            duration = EXTENSIVE_TEST_ITERATIONS
+            # 14MB
+            rng_iterations = 524288
+        adaptive = self.adaptive_checkbox is not None and self.adaptive_checkbox.isChecked()
+        iterations = self.selected_iterations()
+        if iterations is None and adaptive:
+            iterations = duration
+
+        if self.algtest_runner is not None:
+            self.algtest_runner.close_io()
+        self.out_dir = new_out_dir(not self.replaying()) if checkpoint is None else checkpoint.out_dir
+        self.text.clearText()
+        self.text_cursor = 0
+        self.applied_beat = None
+        self.algtest_runner = AlgtestTestRunner(self.out_dir, extensive, resume=checkpoint is not None,
+                                                iterations=iterations, adaptive=adaptive,
+                                                time_budget=self.selected_time_budget(),
+                                                **(session_options(self.args) if self.args is not None else {}))
+        # self.algtest_runner.set_mail(self.email_field.value())
+
+        self.algtest_runner.start()
+        # no probes of the depository during the measurements, the results are uploaded afterwards
+        self.connectivity.pause()
+
+    def refresh_active(self):
+        """Whether the UI shows progress which needs to be redrawn regularly."""
+        if self.algtest_runner is None:
+            return False
+        snapshot = self.algtest_runner.get_snapshot()
+        return not snapshot.finished or snapshot.io_busy or self.shutdown_pending or \
+            snapshot.version != self.snapshot_version
+
+    def apply_heartbeat(self):
+        """Show the liveness of the runner, at most once per frame."""
+        heartbeat = self.algtest_runner.heartbeat
+        beat = (heartbeat.count, heartbeat.alive)
+        if beat != self.applied_beat:
+            self.applied_beat = beat
+            self.busy_indicator.setAlive(heartbeat.alive)
+
+        stall_timeout = self.args.stall_timeout if self.args is not None else HEARTBEAT_STALL_TIMEOUT
+        stalled = heartbeat.check_stall(stall_timeout)
+        if stalled is not None:
+            self.algtest_runner.report_stall(stalled)
+
+    def refresh(self, snapshot):
+        set_widget = self.refresh_scheduler.set
+        self.snapshot_version = snapshot.version
+        set_widget(self.progress_bar, "setValue", snapshot.percentage)
+        set_widget(self.eta_label, "setText", self.eta_text(snapshot))
+        if self.analysis_button is not None:
+            set_widget(self.analysis_button, "setEnabled", snapshot.analyzed)
+        if self.text_cursor is None:
+            self.text_cursor, lines = self.algtest_runner.get_text_since(0)
+            self.text.setLogText("\n".join(lines[-LOG_VIEW_STORED_LINES:]) + "\n")
+        else:
+            self.text_cursor, lines = self.algtest_runner.get_text_since(self.text_cursor)
+            if lines:
+                self.text.appendLines("\n".join(lines) + "\n")
+        if snapshot.upload_progress is not None:
+            sent, total = snapshot.upload_progress
+            set_widget(self.busy_indicator, "setLabel", "Uploading results: %.1f / %.1f MB" % (sent / 2**20, total / 2**20))
+        else:
+            set_widget(self.busy_indicator, "setLabel", snapshot.status)
+
+        if self.exit_pending:
+            # the progress of the upload stays in the busy indicator
+            set_widget(self.running_label, "setText", "Stopping the test" if not snapshot.finished else
+                       "Storing the results, the application exits when done")
+            set_widget(self.running_label, "setUseBoldFont", True)
+        elif self.replaying() and snapshot.finished:
+            set_widget(self.running_label, "setText", "Replay finished, the results are not stored")
+            set_widget(self.running_label, "setUseBoldFont", True)
+        elif snapshot.state == AlgtestState.NOT_RUNNING:
+            set_widget(self.running_label, "setText", "Test is not yet running")
+            set_widget(self.running_label, "setUseBoldFont", False)
+        elif snapshot.state == AlgtestState.RUNNING and snapshot.stall is not None:
+            set_widget(self.running_label, "setText", "The test seems to be stuck. " + snapshot.stall)
+            set_widget(self.running_label, "setUseBoldFont", True)
+        elif snapshot.state == AlgtestState.RUNNING:
+            set_widget(self.running_label, "setText", "Test is running, please do not power off your computer and plug it into AC")
+            set_widget(self.running_label, "setUseBoldFont", True)
+        elif snapshot.state == AlgtestState.SUCCESS:
+            if self.result_saved():
+                set_widget(self.running_label, "setText", "Test finished successfully and the result was stored. You can exit now.")
+            else:
+                set_widget(self.running_label, "setText", "Testing completed, storing the result")
+            set_widget(self.running_label, "setUseBoldFont", True)
+        elif snapshot.state == AlgtestState.FAILED:
+            if self.result_saved():
+                set_widget(self.running_label, "setText", "Test failed and the partial result was stored. Try to re-run the test.")
+            else:
+                set_widget(self.running_label, "setText", "Test failed, storing the partial result")
+            set_widget(self.running_label, "setUseBoldFont", True)
+
+    def close_ui(self):
+        if self.algtest_runner is not None:
+            self.algtest_runner.close_io()
+        self.connectivity.stop()
+        print(self.refresh_scheduler.summary(), file=sys.stderr)
+        self.dialog.destroy()
+        self.dialog = None
+
     def main_ui_loop(self):
         self.popup_info_show()
+        if self.popup_info is None:
+            self.popup_ask_resume()
         while self.dialog is not None and self.dialog.isOpen():
-            ev = self.dialog.topmostDialog().waitForEvent(100)
-
-            if self.algtest_runner is not None and self.algtest_runner.is_finished() and self.dialog.topmostDialog() != self.popup and not self.result_stored:
-                self.algtest_runner.store_results(StoreType.STORE_USB)
+            ev = self.dialog.topmostDialog().waitForEvent(self.refresh_scheduler.wait_timeout(self.refresh_active()))
+
+            snapshot = self.algtest_runner.get_snapshot() if self.algtest_runner is not None else None
+            if snapshot is not None and snapshot.finished and self.connectivity.paused.is_set():
+                self.connectivity.resume()
+            if snapshot is not None and snapshot.finished and self.dialog.topmostDialog() != self.popup and \
+                    not self.result_stored and not self.replaying() and not self.exit_pending:
+                self.algtest_runner.submit_store(StoreType.STORE_USB)
                 self.result_stored = True
-                if self.shutdown_checkbox.isChecked() and self.algtest_runner.get_state() == AlgtestState.SUCCESS:
-                    self.algtest_runner.store_results(StoreType.UPLOAD)
-                    os.system("shutdown -h now")
+                if self.shutdown_checkbox is not None and self.shutdown_checkbox.isChecked() and self.algtest_runner.get_state() == AlgtestState.SUCCESS:
+                    self.algtest_runner.submit_store(StoreType.UPLOAD)
+                    self.shutdown_pending = True
                 if self.store_button is None:
-                    self.popup_ask_upload()
                     self.store_button = YUI.widgetFactory().createPushButton(self.bottom_buttons, "&Upload results")
+                    self.popup_ask_upload()
 
             if ev.eventType() == YEvent.CancelEvent or (self.exit_button is not None and ev.widget() == self.exit_button):
                 if self.popup is not None:
@@ -741,48 +3636,68 @@ class TPM2AlgtestUI:
                 if self.popup_info is not None:
                     self.popup_info.destroy()
                     self.popup_info = None
+                    self.popup_ask_resume()
                     continue
 
-                if self.algtest_runner.is_alive():
-                    self.algtest_runner.terminate()
+                if self.popup_resume is not None:
+                    self.close_popup_resume()
+                    continue
 
+                if self.popup_budget is not None:
+                    self.close_popup_budget()
+                    continue
+
+                if self.popup_analysis is not None:
+                    self.close_popup_analysis()
+                    continue
+
+                if self.algtest_runner is not None:
+                    if self.algtest_runner.is_alive():
+                        # the timeout events close the UI once the runner exited
+                        self.algtest_runner.stop()
+                    if self.algtest_runner.is_alive() or self.algtest_runner.io_busy():
+                        # do not leave a half-written archive on the USB, exit once it is stored
+                        self.exit_pending = True
+                        self.snapshot_version = None
+                        continue
 
-                self.dialog.destroy()
-                self.dialog = None
+                self.close_ui()
             elif ev.eventType() == YEvent.WidgetEvent:
                 if ev.widget() == self.stop_button:
-                    self.algtest_runner.terminate()
+                    # the runner terminates the process and reports the stop itself
+                    self.algtest_runner.stop()
                 elif ev.widget() in [self.start_short_button, self.start_extensive_button]:
                     if self.algtest_runner is not None and self.algtest_runner.is_alive():
                         continue
-                    if self.store_button is not None:
-                        self.store_button.parent().removeChild(self.store_button)
-                        self.store_button = None
-                        self.result_stored = False
-
-                    self.out_dir = os.path.join(mkdtemp(), "tpm2-algtest", "algtest_result_" + str(uuid4()))
-                    os.makedirs(self.out_dir, exist_ok=True)
-                    self.algtest_runner = AlgtestTestRunner(self.out_dir, ev.widget() == self.start_extensive_button, lambda alive: self.busy_indicator.setAlive(alive))
-                    # self.algtest_runner.set_mail(self.email_field.value())
-
-                    if ev.widget() == self.start_short_button:
-                        duration = SHORT_TEST_ITERATIONS
-                        rng_iterations = 16384
-                    elif ev.widget() == self.start_extensive_button:
-                        duration = EXTENSIVE_TEST_ITERATIONS
-                        # 14MB
-                        rng_iterations = 524288
-
-                    self.algtest_runner.start()
+                    if self.selected_time_budget() is not None:
+                        self.popup_ask_budget(ev.widget() == self.start_extensive_button)
+                    else:
+                        self.start_test(ev.widget() == self.start_extensive_button)
+                elif ev.widget() == self.popup_budget_start_button:
+                    extensive = self.budget_extensive
+                    self.close_popup_budget()
+                    if self.algtest_runner is None or not self.algtest_runner.is_alive():
+                        self.start_test(extensive)
+                elif ev.widget() == self.popup_budget_cancel_button:
+                    self.close_popup_budget()
+                elif ev.widget() == self.popup_resume_button:
+                    checkpoint = self.unfinished_run
+                    self.close_popup_resume()
+                    if self.algtest_runner is None or not self.algtest_runner.is_alive():
+                        self.start_test(checkpoint.extensive, checkpoint)
+                elif ev.widget() == self.popup_discard_button:
+                    self.unfinished_run.remove()
+                    self.close_popup_resume()
                 elif ev.widget() == self.popup_cancel:
                     self.popup.destroy()
                     self.popup = None
                 elif ev.widget() == self.popup_upload:
-                    self.algtest_runner.store_results(StoreType.UPLOAD)
+                    self.algtest_runner.submit_store(StoreType.UPLOAD)
                     self.popup.destroy()
                     self.popup = None
                 elif ev.widget() == self.popup_configure:
                     os.system("gnome-control-center wifi&")
+                    self.connectivity.refresh()
                 elif ev.widget() == self.store_button:
                     self.popup_ask_upload()
                 elif ev.widget() == self.shutdown_button:
@@ -790,8 +3705,13 @@ class TPM2AlgtestUI:
                 elif ev.widget() == self.popup_info_hide_button:
                     self.popup_info.destroy()
                     self.popup_info = None
+                    self.popup_ask_resume()
                 elif ev.widget() == self.info_button:
                     self.popup_info_show()
+                elif ev.widget() == self.analysis_button:
+                    self.popup_analysis_show()
+                elif ev.widget() == self.popup_analysis_close_button:
+                    self.close_popup_analysis()
                 elif ev.widget() == self.advanced_button:
                     self.dialog.destroy()
                     self.reset_ui_members()
@@ -802,33 +3722,252 @@ class TPM2AlgtestUI:
                     self.construct_simple_ui()
 
             elif ev.eventType() == YEvent.TimeoutEvent:
-                if self.algtest_runner is not None and self.algtest_runner.get_info_changed():
-                    self.progress_bar.setValue(self.algtest_runner.get_percentage())
-                    if self.algtest_runner.get_text():
-                        self.text.setText(self.algtest_runner.get_text())
-                    self.busy_indicator.setLabel(self.algtest_runner.get_status())
-
-                    if self.algtest_runner.get_state() == AlgtestState.NOT_RUNNING:
-                        self.running_label.setText("Test is not yet running")
-                        self.running_label.setUseBoldFont(False)
-                    elif self.algtest_runner.get_state() == AlgtestState.RUNNING:
-                        self.running_label.setText("Test is running, please do not power off your computer and plug it into AC")
-                        self.running_label.setUseBoldFont(True)
-                    elif self.algtest_runner.get_state() == AlgtestState.SUCCESS:
-                        if self.result_stored:
-                            self.running_label.setText("Test finished successfully and the result was stored. You can exit now.")
-                        else:
-                            self.running_label.setText("Testing completed, storing the result")
-                        self.running_label.setUseBoldFont(True)
-                    elif self.algtest_runner.get_state() == AlgtestState.FAILED:
-                        if self.result_stored:
-                            self.running_label.setText("Test failed and the partial result was stored. Try to re-run the test.")
-                        else:
-                            self.running_label.setText("Test failed, storing the partial result")
-                        self.running_label.setUseBoldFont(True)
+                if self.exit_pending and not self.algtest_runner.is_alive() and not self.algtest_runner.io_busy():
+                    self.close_ui()
+                    continue
+                if snapshot is not None and snapshot.io_busy:
+                    self.busy_indicator.setAlive(True)
+                elif self.shutdown_pending:
+                    self.shutdown_pending = False
+                    os.system("shutdown -h now")
+                elif self.algtest_runner is not None:
+                    self.apply_heartbeat()
+                self.show_connectivity()
+                if not self.replaying():
+                    self.drain_outbox()
+                if snapshot is not None and snapshot.version != self.snapshot_version and \
+                        self.refresh_scheduler.frame_due():
+                    self.refresh_scheduler.begin_frame(snapshot.version)
+                    self.refresh(snapshot)
+                    self.refresh_scheduler.end_frame()
+
+
+
+def emit(event, **fields):
+    """Print one line of the machine-readable progress of the headless mode."""
+    with EMIT_LOCK:
+        print(json.dumps(dict(fields, event=event)), flush=True)
+
+
+class DeviceRun:
+    """Test of one TPM in the headless mode and the progress reported so far."""
+    def __init__(self, runner, device=None, stall_timeout=HEARTBEAT_STALL_TIMEOUT):
+        self.runner = runner
+        self.device = device
+        self.stall_timeout = stall_timeout
+        self.cursor = 0
+        self.version = None
+        self.status = None
+        self.progress = None
+        # the progress is reported by the main thread and by the worker storing the results
+        self.lock = Lock()
+
+    def emit(self, event, **fields):
+        if self.device is not None:
+            fields["device"] = self.device
+        emit(event, **fields)
+
+    def report(self):
+        with self.lock:
+            self.report_changes()
+
+    def report_changes(self):
+        stalled = self.runner.heartbeat.check_stall(self.stall_timeout)
+        if stalled is not None:
+            self.runner.report_stall(stalled)
+            self.emit("stall", seconds=int(stalled), status=self.runner.get_status())
+        snapshot = self.runner.get_snapshot()
+        if snapshot.version == self.version:
+            return
+        self.version = snapshot.version
+
+        self.cursor, lines = self.runner.get_text_since(self.cursor)
+        for line in lines:
+            self.emit("log", line=line)
+        if snapshot.status != self.status:
+            self.status = snapshot.status
+            self.emit("status", status=self.status)
+        eta = snapshot.eta
+        progress = (snapshot.percentage, eta and round(eta[0]))
+        if progress != self.progress:
+            self.progress = progress
+            self.emit("progress", percentage=progress[0], remaining=progress[1], band=eta and round(eta[1]))
+
+    def test(self, store):
+        """Run the test in the runner thread and store its results, return the exit code of the device."""
+        self.runner.start()
+        self.runner.join()
+        if not self.runner.is_finished():
+            # the exception was printed by the runner thread
+            self.emit("log", line="The test crashed.")
+            self.runner.set_state(AlgtestState.FAILED)
+        return self.store(store)
+
+    def store(self, store):
+        """Store the results as selected by --store, return the exit code of the device."""
+        state = self.runner.get_state()
+        store_types = {"usb": [StoreType.STORE_USB], "upload": [StoreType.UPLOAD],
+                       "both": [StoreType.STORE_USB, StoreType.UPLOAD], "none": []}[store]
+        if state != AlgtestState.SUCCESS:
+            # like the UI, only complete results are uploaded
+            store_types = [store_type for store_type in store_types if store_type != StoreType.UPLOAD]
+        for store_type in store_types:
+            self.runner.submit_store(store_type)
+        self.runner.wait_io()
+        self.report()
+
+        stored = True
+        for store_type in store_types:
+            job_state = self.runner.get_job_state(store_type)
+            self.emit("stored", target=store_type.name, state=job_state.name)
+            stored = stored and job_state == IOJobState.SUCCESS
+        # the last event of the device, the log, status and progress are complete by now
+        self.emit("finished", state=state.name, archive=self.runner.out_dir + ".zip")
+
+        if state == AlgtestState.SUCCESS:
+            return HEADLESS_EXIT_SUCCESS if stored else HEADLESS_EXIT_STORE_FAILED
+        if state == AlgtestState.STOPPED:
+            return HEADLESS_EXIT_STOPPED
+        return HEADLESS_EXIT_FAILED
+
+
+def session_options(args):
+    """Runner arguments to record or replay a session as requested by the command line."""
+    return {
+        "record": args.record,
+        "replay": SessionReplay(args.replay, args.replay_speed) if args.replay else None,
+    }
+
+
+def run_headless(args):
+    """Run the test without the UI, report the progress as JSON lines on stdout.
+
+    Every TPM given by --tcti gets its own runner and output directory, at
+    most --jobs of them are tested at the same time. With more than one
+    TPM, every event carries the TCTI of its device and "overall" events
+    aggregate the progress. The results of every device are stored as soon
+    as its test finishes. Returns the most severe of the HEADLESS_EXIT_*
+    codes of the devices.
+    """
+    # the unfinished runs and the output directories are on the result volume
+    mount_result_path()
+    checkpoint = None
+    if args.resume:
+        unfinished_runs = find_unfinished_runs()
+        checkpoint = unfinished_runs[0] if unfinished_runs else None
+        if checkpoint is None:
+            emit("log", line="There is no unfinished test to resume, starting a new one.")
+
+    store = args.store
+    if args.replay and store != "none":
+        emit("log", line="The results of a replayed session are not stored.")
+        store = "none"
+
+    runs = []
+    for tcti in args.tcti:
+        out_dir = new_out_dir(not args.replay) if checkpoint is None else checkpoint.out_dir
+        runner = AlgtestTestRunner(out_dir, args.extensive, resume=checkpoint is not None,
+                                   iterations=args.iterations, adaptive=args.adaptive,
+                                   time_budget=args.time_budget * 60 if args.time_budget else None, tcti=tcti,
+                                   **session_options(args))
+        runs.append(DeviceRun(runner, tcti if len(args.tcti) > 1 else None, args.stall_timeout))
+
+    def stop(*_):
+        for run in runs:
+            run.runner.stop()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, stop)
+
+    for run in runs:
+        run.emit("start", version=VERSION, out_dir=run.runner.out_dir, resume=checkpoint is not None)
+
+    # every worker of the pool starts a runner thread and waits for it, at most --jobs run at once
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        tests = [pool.submit(run.test, store) for run in runs]
+        while True:
+            done, _ = wait(tests, timeout=HEADLESS_POLL_INTERVAL)
+            for run in runs:
+                run.report()
+            if len(runs) > 1:
+                snapshots = [run.runner.get_snapshot() for run in runs]
+                states = [snapshot.state for snapshot in snapshots]
+                emit("overall", percentage=sum(snapshot.percentage for snapshot in snapshots) // len(runs),
+                     **{state.name.lower(): states.count(state) for state in AlgtestState})
+            if len(done) == len(tests):
+                break
+
+    codes = []
+    for run, test in zip(runs, tests):
+        if test.exception() is not None:
+            run.emit("log", line="Storing the results failed: %r" % test.exception())
+            codes.append(HEADLESS_EXIT_FAILED)
+        else:
+            codes.append(test.result())
+    code = max(codes, key=HEADLESS_EXIT_SEVERITY.index)
+
+    if store in ("upload", "both"):
+        # also the archives of earlier runs which were not uploaded
+        results = UploadOutbox().drain(ISUploader("tpm2-algtest-ui", DEPOSITORY_UCO))
+        for name, state in (results or {}).items():
+            emit("outbox", archive=name, state=state)
+    return code
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TPM2 algorithms test " + VERSION)
+    parser.add_argument("--headless", action="store_true",
+                        help="run the test without the UI, print the progress as JSON lines")
+    parser.add_argument("--extensive", action="store_true", help="run the extensive test")
+    parser.add_argument("--resume", action="store_true", help="resume the last unfinished test")
+    parser.add_argument("--iterations", type=int, help="number of repetitions of the performance tests")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="use as many repetitions as earlier runs on this TPM needed for precise results")
+    parser.add_argument("--time-budget", type=int, metavar="MINUTES", help="finish the test within MINUTES")
+    parser.add_argument("--tcti", action="append",
+                        help="TCTI of the TPM to test, repeat to test several TPMs (default: %s)" % TCTII)
+    parser.add_argument("--jobs", type=int, default=HEADLESS_JOBS,
+                        help="number of TPMs tested at the same time (default: %d)" % HEADLESS_JOBS)
+    parser.add_argument("--record", metavar="FILE", help="record the output of run_algtest into the session FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay the session FILE instead of running run_algtest, no TPM is used")
+    parser.add_argument("--replay-speed", type=float, default=1.0, metavar="FACTOR",
+                        help="speed of the replay relative to the recording, 0 for as fast as possible")
+    parser.add_argument("--stall-timeout", type=int, default=HEARTBEAT_STALL_TIMEOUT, metavar="SECONDS",
+                        help="report the test as stalled after SECONDS without output (default: %d)"
+                             % HEARTBEAT_STALL_TIMEOUT)
+    parser.add_argument("--store", choices=["usb", "upload", "both", "none"], default="usb",
+                        help="where to store the results (default: usb), uploading also uploads the archives "
+                             "which earlier runs left on the USB")
+    # the remaining arguments (e.g. -fullscreen) are for libyui
+    args, _ = parser.parse_known_args(argv)
+    if args.tcti is None:
+        args.tcti = [TCTII]
+    if len(args.tcti) > 1:
+        for option in ("resume", "record", "replay"):
+            if getattr(args, option):
+                parser.error("--%s works with a single TPM only" % option)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.adaptive and args.iterations is None:
+        args.iterations = EXTENSIVE_TEST_ITERATIONS if args.extensive else SHORT_TEST_ITERATIONS
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.headless:
+        return run_headless(args)
+
+    # libyui is only needed by the UI and takes a while to load
+    global YUI, YEvent
+    from yui import YUI, YEvent
+
+    ui = TPM2AlgtestUI(args)
+    ui.construct_simple_ui()
+    ui.main_ui_loop()
+    return 0
 
 
 if __name__ == "__main__":
-    ui = TPM2AlgtestUI()
-    ui.construct_simple_ui()
-    ui.main_ui_loop()
+    sys.exit(main())